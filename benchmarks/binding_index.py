@@ -0,0 +1,97 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Micro-benchmark comparing per-queue binding lookups done by scanning the
+full binding list against lookups in a ``BindingIndex``.
+
+The linear scan is quadratic over a whole guard cycle, so it is only timed
+on a sample of queues and extrapolated to the full queue count.
+
+    python benchmarks/binding_index.py --queues 10000 --bindings 50000
+"""
+
+import base64
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+os.environ.setdefault('FLASK_SECRET_KEY', base64.b64encode(os.urandom(24)))
+
+from pulseguardian.management import BindingIndex
+
+DEFAULT_QUEUES = 10000
+DEFAULT_BINDINGS = 50000
+DEFAULT_SAMPLE = 200
+
+
+def generate(num_queues, num_bindings):
+    queues = [{'name': 'queue/user{0}/q{1}'.format(i % 100, i), 'vhost': '/'}
+              for i in xrange(num_queues)]
+    bindings = []
+    for i in xrange(num_bindings):
+        queue = queues[random.randrange(num_queues)]
+        bindings.append({
+            'source': 'exchange/test/{0}'.format(i % 20),
+            'destination': queue['name'],
+            'destination_type': 'queue',
+            'routing_key': 'key.{0}'.format(i),
+            'vhost': queue['vhost'],
+        })
+    return queues, bindings
+
+
+def linear_scan(all_bindings, queue_name):
+    """The lookup PulseGuardian used before bindings were indexed."""
+    return [x for x in all_bindings if
+            x["destination_type"] == "queue" and
+            x["destination"] == queue_name]
+
+
+def main(opts):
+    queues, bindings = generate(opts.queues, opts.bindings)
+    sample = random.sample(queues, min(opts.sample, len(queues)))
+
+    start = time.time()
+    for queue in sample:
+        linear_scan(bindings, queue['name'])
+    scan_time = (time.time() - start) * len(queues) / len(sample)
+
+    start = time.time()
+    index = BindingIndex(bindings)
+    build_time = time.time() - start
+
+    start = time.time()
+    for queue in queues:
+        index.queue_bindings(queue['vhost'], queue['name'])
+    lookup_time = time.time() - start
+
+    index_time = build_time + lookup_time
+    print '{0} queues x {1} bindings'.format(opts.queues, opts.bindings)
+    print '  linear scan:   {0:.3f}s (extrapolated from {1} queues)'.format(
+        scan_time, len(sample))
+    print '  binding index: {0:.3f}s ({1:.3f}s build, {2:.3f}s lookups)'\
+        .format(index_time, build_time, lookup_time)
+    print '  speedup:       {0:.0f}x'.format(scan_time / index_time)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('--queues', action='store', type='int', dest='queues',
+                      default=DEFAULT_QUEUES,
+                      help='number of queues; defaults to %d' %
+                      DEFAULT_QUEUES)
+    parser.add_option('--bindings', action='store', type='int',
+                      dest='bindings', default=DEFAULT_BINDINGS,
+                      help='number of bindings; defaults to %d' %
+                      DEFAULT_BINDINGS)
+    parser.add_option('--sample', action='store', type='int', dest='sample',
+                      default=DEFAULT_SAMPLE,
+                      help='queues timed with the linear scan; defaults to %d'
+                      % DEFAULT_SAMPLE)
+    (opts, args) = parser.parse_args()
+    main(opts)
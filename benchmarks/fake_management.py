@@ -0,0 +1,209 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""A fake RabbitMQ management API serving a synthetic broker, for
+benchmarks.
+
+Only the calls made by the guardian are implemented: the (paginated)
+queue listing, the binding listing, single queues and queue deletion.
+"""
+
+import json
+import random
+import threading
+import urllib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+
+# How queue sizes evolve from one cycle to the next:
+#   steady: sizes don't change.
+#   growth: a fraction of the queues grow steadily, eventually crossing the
+#           warning and deletion thresholds; the others fluctuate a little.
+#   churn:  like steady, but a fraction of the queues are replaced by new
+#           ones every cycle.
+PATTERNS = ('steady', 'growth', 'churn')
+
+
+class FakeBroker(object):
+    """Synthetic broker state.
+
+    :param num_queues: Number of queues.
+    :param num_bindings: Number of bindings, spread over the queues.
+    :param num_users: Number of Pulse users owning the queues.
+    :param pattern: One of ``PATTERNS``.
+    :param hot_fraction: Fraction of the queues that grow or churn.
+    :param warn_size: Warning threshold, used to scale queue sizes.
+    """
+
+    def __init__(self, num_queues, num_bindings, num_users, pattern='steady',
+                 hot_fraction=0.01, warn_size=2000, seed=0):
+        if pattern not in PATTERNS:
+            raise ValueError('Unknown growth pattern: {0}'.format(pattern))
+        self.num_users = num_users
+        self.pattern = pattern
+        self.hot_fraction = hot_fraction
+        self.warn_size = warn_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.deleted = 0
+        self._next_id = 0
+        self._num_bindings = num_bindings
+
+        self.queues = {}
+        for i in xrange(num_queues):
+            self._add_queue()
+        self.hot = set(self.random.sample(sorted(self.queues),
+                                          int(num_queues * hot_fraction)))
+        self._generate_bindings()
+
+    def _add_queue(self):
+        name = 'queue/user{0}/q{1}'.format(self._next_id % self.num_users,
+                                           self._next_id)
+        self._next_id += 1
+        size = self.random.randint(0, self.warn_size / 2)
+        self.queues[name] = {
+            'name': name,
+            'vhost': '/',
+            'messages': size,
+            'messages_ready': size,
+            'durable': self.random.random() < 0.5,
+        }
+        return name
+
+    def _generate_bindings(self):
+        names = sorted(self.queues)
+        self.bindings = []
+        for i in xrange(self._num_bindings):
+            self.bindings.append({
+                'source': 'exchange/user{0}/{1}'.format(
+                    i % self.num_users, i % 7),
+                'vhost': '/',
+                'destination': names[i % len(names)],
+                'destination_type': 'queue',
+                'routing_key': 'key.{0}'.format(i),
+                'arguments': {},
+            })
+
+    def advance(self):
+        """Move on to the next cycle's state."""
+        with self.lock:
+            if self.pattern == 'growth':
+                for name, queue in self.queues.iteritems():
+                    if name in self.hot:
+                        size = queue['messages'] + self.warn_size
+                    else:
+                        size = max(0, queue['messages'] +
+                                   self.random.randint(-5, 5))
+                    queue['messages'] = queue['messages_ready'] = size
+            elif self.pattern == 'churn':
+                replaced = {}
+                for name in list(self.hot):
+                    if self.queues.pop(name, None) is not None:
+                        self.hot.discard(name)
+                        replaced[name] = self._add_queue()
+                        self.hot.add(replaced[name])
+                for binding in self.bindings:
+                    binding['destination'] = replaced.get(
+                        binding['destination'], binding['destination'])
+
+    def queue_list(self):
+        with self.lock:
+            return [self.queues[name] for name in sorted(self.queues)]
+
+    def queue(self, name):
+        with self.lock:
+            return self.queues.get(name)
+
+    def delete_queue(self, name):
+        with self.lock:
+            if self.queues.pop(name, None) is None:
+                return False
+            self.hot.discard(name)
+            self.deleted += 1
+            self.bindings = [b for b in self.bindings
+                             if b['destination'] != name]
+            return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, data=None):
+        body = json.dumps(data) if data is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _path(self):
+        url = urlparse(self.path)
+        parts = [urllib.unquote(p) for p in url.path.split('/')[2:]]
+        return parts, {k: v[0] for k, v in parse_qs(url.query).items()}
+
+    def do_GET(self):
+        broker = self.server.broker
+        parts, params = self._path()
+
+        if parts == ['bindings']:
+            self._reply(200, broker.bindings)
+        elif parts == ['queues']:
+            queues = broker.queue_list()
+            if 'columns' in params:
+                columns = params['columns'].split(',')
+                queues = [{k: q[k] for k in columns if k in q}
+                          for q in queues]
+            if 'page' in params:
+                page = int(params['page'])
+                page_size = int(params.get('page_size', 100))
+                page_count = max(1, -(-len(queues) // page_size))
+                self._reply(200, {
+                    'items': queues[(page - 1) * page_size:
+                                    page * page_size],
+                    'page': page,
+                    'page_count': page_count,
+                    'page_size': page_size,
+                    'total_count': len(queues),
+                })
+            else:
+                self._reply(200, queues)
+        elif len(parts) == 3 and parts[0] == 'queues':
+            queue = broker.queue(parts[2])
+            if queue is None:
+                self._reply(404, {'error': 'Object Not Found',
+                                  'reason': 'Not Found'})
+            else:
+                self._reply(200, dict(queue, incoming=[]))
+        else:
+            self._reply(404, {'error': 'Object Not Found',
+                              'reason': 'Not Found'})
+
+    def do_DELETE(self):
+        parts, params = self._path()
+        if (len(parts) == 3 and parts[0] == 'queues' and
+                self.server.broker.delete_queue(parts[2])):
+            self._reply(204)
+        else:
+            self._reply(404, {'error': 'Object Not Found',
+                              'reason': 'Not Found'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(broker, host='127.0.0.1', port=0):
+    """Serve ``broker`` from a background thread.  Returns the server; its
+    API URL is ``'http://{0}:{1}/api/'.format(*server.server_address)``."""
+    server = _Server((host, port), _Handler)
+    server.broker = broker
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
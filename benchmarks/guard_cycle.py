@@ -0,0 +1,261 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""End-to-end benchmark of guard cycles against a simulated broker.
+
+A fake management API (see ``fake_management.py``) serves synthetic
+queues, bindings and users whose sizes evolve from one cycle to the next
+following a growth pattern.  Each cycle fetches them and runs
+``monitor_queues`` and ``clear_deleted_queues`` as ``guard`` does, against
+a throwaway SQLite database unless ``DATABASE_URL`` is set (e.g. to a
+scratch PostgreSQL database; its tables are dropped!).  Cycle latency,
+database query counts and peak memory are reported for every queue count.
+
+    python benchmarks/guard_cycle.py --queues 1000,10000 --output new.json
+    python benchmarks/guard_cycle.py --queues 1000,10000 --baseline new.json
+"""
+
+import base64
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+os.environ.setdefault('FLASK_SECRET_KEY', base64.b64encode(os.urandom(24)))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///{0}'.format(
+    os.path.join(tempfile.mkdtemp(), 'benchmark.db')))
+
+from fake_management import FakeBroker, PATTERNS, serve
+from pulseguardian import (config, guardian, listing,
+                           management as pulse_management)
+from pulseguardian.model.base import Base, QueryCount, db_session, engine
+from pulseguardian.model.pulse_user import PulseUser
+from pulseguardian.model.user import User
+
+DEFAULT_QUEUES = '1000,10000,100000'
+DEFAULT_BINDINGS_PER_QUEUE = 2
+DEFAULT_USERS = 100
+DEFAULT_CYCLES = 5
+DEFAULT_PATTERN = 'growth'
+DEFAULT_HOT_FRACTION = 0.01
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on OS X.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss / 1024.0
+
+
+def reset_database(num_users):
+    db_session.remove()
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    db_session.add(User(email='admin@example.com', admin=True))
+    for i in xrange(num_users):
+        owner = User(email='user{0}@example.com'.format(i))
+        db_session.add(PulseUser(username='user{0}'.format(i),
+                                 owners=[owner]))
+    db_session.commit()
+
+
+def run_cycle(pulse_guardian):
+    """One guard cycle, minus the sleeping and the side-effect stages."""
+    started = time.time()
+    fetcher = guardian.QueueFetcher(config.guard_buffer_size)
+    fetcher.start()
+    try:
+        bindings = fetcher.bindings()
+        all_queues = []
+        pulse_guardian.monitor_queues(
+            pulse_guardian._owned_queues(fetcher.queues(), all_queues),
+            bindings, started)
+    finally:
+        fetcher.stop()
+    monitored = time.time()
+    pulse_guardian.clear_deleted_queues(all_queues, bindings)
+    cleared = time.time()
+    if config.queue_snapshots:
+        listing.publish()
+    finished = time.time()
+    return {
+        'seconds': finished - started,
+        'monitor_seconds': monitored - started,
+        'clear_seconds': cleared - monitored,
+        'publish_seconds': finished - cleared,
+    }
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def benchmark(num_queues, opts):
+    broker = FakeBroker(num_queues,
+                        num_queues * opts.bindings_per_queue,
+                        opts.users, opts.pattern, opts.hot_fraction,
+                        config.warn_queue_size)
+    server = serve(broker)
+    config.rabbit_management_url = 'http://{0}:{1}/api/'.format(
+        *server.server_address)
+    reset_database(opts.users)
+
+    pulse_guardian = guardian.PulseGuardian(emails=False)
+    cycles = []
+    try:
+        for i in xrange(opts.cycles):
+            with QueryCount() as queries:
+                cycle = run_cycle(pulse_guardian)
+            cycle['queries'] = queries.total
+            cycle['repeated_queries'] = queries.repeated(
+                config.query_repeat_threshold, config.query_top_offenders)
+            cycles.append(cycle)
+            broker.advance()
+    finally:
+        # Close the kept-alive connections before stopping the server.
+        if pulse_management._adapter is not None:
+            pulse_management._adapter.close()
+        server.shutdown()
+        server.server_close()
+
+    # The first cycle creates every record; the following ones show the
+    # steady state.
+    steady = cycles[1:] or cycles
+    return {
+        'queues': num_queues,
+        'bindings': num_queues * opts.bindings_per_queue,
+        'users': opts.users,
+        'pattern': opts.pattern,
+        'cycles': cycles,
+        'initial_seconds': cycles[0]['seconds'],
+        'initial_queries': cycles[0]['queries'],
+        'median_seconds': median([c['seconds'] for c in steady]),
+        'max_seconds': max(c['seconds'] for c in steady),
+        'median_queries': median([c['queries'] for c in steady]),
+        'deleted_queues': broker.deleted,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def report(result):
+    print '{queues} queues, {bindings} bindings, {users} users ' \
+        '({pattern})'.format(**result)
+    print '  initial cycle: {0:.3f}s, {1} queries'.format(
+        result['initial_seconds'], result['initial_queries'])
+    print '  steady cycles: {0:.3f}s median, {1:.3f}s max, ' \
+        '{2} queries median'.format(result['median_seconds'],
+                                    result['max_seconds'],
+                                    result['median_queries'])
+    print '  queues deleted: {0}'.format(result['deleted_queues'])
+    print '  peak RSS:      {0:.1f} MB'.format(result['peak_rss_mb'])
+    repeated = result['cycles'][-1]['repeated_queries']
+    if repeated:
+        print '  most repeated queries (last cycle):'
+        for statement, count in repeated:
+            print '    {0:>6}x {1:.60}'.format(count,
+                                            ' '.join(statement.split()))
+
+
+def compare(results, baseline, max_regression):
+    """Print the changes from the baseline results and return whether
+    any metric regressed by more than ``max_regression`` percent."""
+    baseline = {(r['queues'], r['pattern']): r for r in baseline['results']}
+    regressed = False
+    for result in results:
+        before = baseline.get((result['queues'], result['pattern']))
+        if before is None:
+            continue
+        print '{queues} queues ({pattern}) vs. baseline:'.format(**result)
+        for key in ('initial_seconds', 'median_seconds', 'initial_queries',
+                    'median_queries', 'peak_rss_mb'):
+            if not before[key]:
+                continue
+            change = 100.0 * (result[key] - before[key]) / before[key]
+            flag = ''
+            if max_regression is not None and change > max_regression:
+                flag = '  REGRESSION'
+                regressed = True
+            print '  {0:16} {1:>10.3f} -> {2:>10.3f} ({3:+.1f}%){4}'.format(
+                key, before[key], result[key], change, flag)
+    return regressed
+
+
+def main(opts):
+    results = []
+    for num_queues in [int(n) for n in opts.queues.split(',')]:
+        stdout = sys.stdout
+        if not opts.verbose:
+            # Keep the cost of logging, but not the output.
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            result = benchmark(num_queues, opts)
+        finally:
+            if sys.stdout is not stdout:
+                sys.stdout.close()
+                sys.stdout = stdout
+        report(result)
+        results.append(result)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({'database': engine.dialect.name,
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, opts.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('--queues', action='store', type='string',
+                      dest='queues', default=DEFAULT_QUEUES,
+                      help='comma-separated queue counts; defaults to %s' %
+                      DEFAULT_QUEUES)
+    parser.add_option('--bindings-per-queue', action='store', type='int',
+                      dest='bindings_per_queue',
+                      default=DEFAULT_BINDINGS_PER_QUEUE,
+                      help='bindings per queue; defaults to %d' %
+                      DEFAULT_BINDINGS_PER_QUEUE)
+    parser.add_option('--users', action='store', type='int', dest='users',
+                      default=DEFAULT_USERS,
+                      help='number of Pulse users; defaults to %d' %
+                      DEFAULT_USERS)
+    parser.add_option('--cycles', action='store', type='int', dest='cycles',
+                      default=DEFAULT_CYCLES,
+                      help='guard cycles per queue count; defaults to %d' %
+                      DEFAULT_CYCLES)
+    parser.add_option('--pattern', action='store', type='choice',
+                      choices=PATTERNS, dest='pattern',
+                      default=DEFAULT_PATTERN,
+                      help='how queue sizes evolve (%s); defaults to %s' %
+                      (', '.join(PATTERNS), DEFAULT_PATTERN))
+    parser.add_option('--hot-fraction', action='store', type='float',
+                      dest='hot_fraction', default=DEFAULT_HOT_FRACTION,
+                      help='fraction of queues growing or churning; '
+                      'defaults to %s' % DEFAULT_HOT_FRACTION)
+    parser.add_option('--output', action='store', dest='output',
+                      help='write the results to this JSON file')
+    parser.add_option('--baseline', action='store', dest='baseline',
+                      help='compare the results to this JSON file')
+    parser.add_option('--max-regression', action='store', type='float',
+                      dest='max_regression',
+                      help='with --baseline, exit with an error if a metric '
+                      'grew by more than this percentage')
+    parser.add_option('--verbose', action='store_true', dest='verbose',
+                      default=False, help='show the guardian logs')
+    (opts, args) = parser.parse_args()
+    main(opts)
@@ -0,0 +1,206 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Query plans and latencies of the guardian's and web views' hot lookups,
+with the schema as it was before the guard lookups were indexed and with
+the current one.
+
+Both schemas are filled with the same synthetic queues, bindings and
+users, in a throwaway SQLite database unless ``DATABASE_URL`` is set (e.g.
+to a scratch PostgreSQL database; its tables are dropped!).
+
+    python benchmarks/query_plans.py --bindings 100000
+"""
+
+import base64
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+os.environ.setdefault('FLASK_SECRET_KEY', base64.b64encode(os.urandom(24)))
+os.environ.setdefault('DATABASE_URL', 'sqlite:///{0}'.format(
+    os.path.join(tempfile.mkdtemp(), 'benchmark.db')))
+
+from sqlalchemy import Column, Integer, MetaData, select, String, Table
+
+from pulseguardian.model.base import Base, db_session, engine
+from pulseguardian.model.binding import Binding
+from pulseguardian.model.queue import Queue
+from pulseguardian.model.user import pulse_user_owners
+
+DEFAULT_BINDINGS = 100000
+DEFAULT_BINDINGS_PER_QUEUE = 2
+DEFAULT_USERS = 100
+DEFAULT_REPEAT = 200
+
+# The tables whose keys and indexes changed, as they were before.
+_before = MetaData()
+BEFORE_TABLES = [
+    Table('bindings', _before,
+          Column('id', Integer, primary_key=True),
+          Column('exchange', String(255)),
+          Column('routing_key', String(255)),
+          Column('queue_name', String(255))),
+    Table('queues', _before,
+          Column('name', String(255), primary_key=True),
+          Column('owner_id', Integer),
+          Column('size', Integer),
+          Column('unbounded', Integer),
+          Column('warned', Integer),
+          Column('durable', Integer, nullable=False)),
+    Table('pulse_user_owners', _before,
+          Column('users_id', Integer),
+          Column('pulse_users_id', Integer)),
+]
+
+
+def create_schema(before):
+    db_session.remove()
+    Base.metadata.drop_all(bind=engine)
+    if not before:
+        Base.metadata.create_all(bind=engine)
+        return
+    replaced = {table.name for table in BEFORE_TABLES}
+    Base.metadata.create_all(bind=engine, tables=[
+        table for table in Base.metadata.sorted_tables
+        if table.name not in replaced])
+    _before.create_all(bind=engine)
+
+
+def populate(opts):
+    """Fill the tables with the same rows every time."""
+    rng = random.Random(0)
+    tables = Base.metadata.tables
+    num_queues = opts.bindings / opts.bindings_per_queue
+    with engine.begin() as connection:
+        connection.execute(tables['users'].insert(), [
+            {'id': i + 1, 'email': 'user{0}@example.com'.format(i),
+             'admin': False} for i in xrange(opts.users)])
+        connection.execute(tables['pulse_users'].insert(), [
+            {'id': i + 1, 'username': 'user{0}'.format(i)}
+            for i in xrange(opts.users)])
+        connection.execute(pulse_user_owners.insert(), [
+            {'users_id': i + 1, 'pulse_users_id': i + 1}
+            for i in xrange(opts.users)])
+        connection.execute(Queue.__table__.insert(), [
+            {'name': queue_name(i, opts), 'owner_id': i % opts.users + 1,
+             'size': rng.randint(0, 5000), 'unbounded': False,
+             'warned': False, 'durable': False}
+            for i in xrange(num_queues)])
+        connection.execute(Binding.__table__.insert(), [
+            {'queue_name': queue_name(i % num_queues, opts),
+             'exchange': 'exchange/user{0}/{1}'.format(i % opts.users, i % 7),
+             'routing_key': 'key.{0}'.format(i)}
+            for i in xrange(opts.bindings)])
+    engine.execute('ANALYZE')
+
+
+def queue_name(i, opts):
+    return 'queue/user{0}/q{1}'.format(i % opts.users, i)
+
+
+def lookups(opts):
+    """Return (description, function returning a random query) pairs for
+    the lookups done every guard cycle and by the web views."""
+    bindings = Binding.__table__
+    queues = Queue.__table__
+    num_queues = opts.bindings / opts.bindings_per_queue
+    rng = random.Random(1)
+
+    def queue_bindings():
+        return select([bindings]).where(
+            bindings.c.queue_name == queue_name(rng.randrange(num_queues),
+                                                opts))
+
+    def binding():
+        i = rng.randrange(opts.bindings)
+        return select([bindings.c.id]).where(
+            (bindings.c.queue_name == queue_name(i % num_queues, opts)) &
+            (bindings.c.exchange == 'exchange/user{0}/{1}'.format(
+                i % opts.users, i % 7)) &
+            (bindings.c.routing_key == 'key.{0}'.format(i)))
+
+    def owned_queues():
+        return select([queues]).where(
+            queues.c.owner_id == rng.randrange(opts.users) + 1)
+
+    def owners():
+        return select([pulse_user_owners]).where(
+            pulse_user_owners.c.pulse_users_id ==
+            rng.randrange(opts.users) + 1)
+
+    return [
+        ('bindings of a queue', queue_bindings),
+        ('binding by key', binding),
+        ('queues of a Pulse user', owned_queues),
+        ('owners of a Pulse user', owners),
+    ]
+
+
+def explain(query):
+    sql = str(query.compile(dialect=engine.dialect,
+                            compile_kwargs={'literal_binds': True}))
+    if engine.dialect.name == 'sqlite':
+        rows = engine.execute('EXPLAIN QUERY PLAN ' + sql)
+        return [row[-1] for row in rows]
+    return [row[0] for row in engine.execute('EXPLAIN ' + sql)]
+
+
+def run(before, opts):
+    create_schema(before)
+    populate(opts)
+    results = []
+    for description, make_query in lookups(opts):
+        plan = explain(make_query())
+        queries = [make_query() for i in xrange(opts.repeat)]
+        with engine.connect() as connection:
+            start = time.time()
+            for query in queries:
+                connection.execute(query).fetchall()
+            elapsed = time.time() - start
+        results.append((description, plan, elapsed / opts.repeat))
+    return results
+
+
+def main(opts):
+    runs = [('before', run(True, opts)), ('after', run(False, opts))]
+    print '{0} bindings, {1} queues, {2} users ({3})'.format(
+        opts.bindings, opts.bindings / opts.bindings_per_queue, opts.users,
+        engine.dialect.name)
+    for i, result in enumerate(runs[0][1]):
+        print
+        print result[0]
+        for label, results in runs:
+            plan, latency = results[i][1:]
+            print '  {0}: {1:.3f} ms'.format(label, latency * 1000)
+            for line in plan:
+                print '    {0}'.format(line)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option('--bindings', action='store', type='int',
+                      dest='bindings', default=DEFAULT_BINDINGS,
+                      help='number of bindings; defaults to %d' %
+                      DEFAULT_BINDINGS)
+    parser.add_option('--bindings-per-queue', action='store', type='int',
+                      dest='bindings_per_queue',
+                      default=DEFAULT_BINDINGS_PER_QUEUE,
+                      help='bindings per queue; defaults to %d' %
+                      DEFAULT_BINDINGS_PER_QUEUE)
+    parser.add_option('--users', action='store', type='int', dest='users',
+                      default=DEFAULT_USERS,
+                      help='number of users and Pulse users; defaults to %d' %
+                      DEFAULT_USERS)
+    parser.add_option('--repeat', action='store', type='int', dest='repeat',
+                      default=DEFAULT_REPEAT,
+                      help='times each lookup is run; defaults to %d' %
+                      DEFAULT_REPEAT)
+    (opts, args) = parser.parse_args()
+    main(opts)
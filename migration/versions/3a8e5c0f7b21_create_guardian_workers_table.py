@@ -0,0 +1,32 @@
+"""create guardian workers table
+
+Revision ID: 3a8e5c0f7b21
+Revises: 1ff5c08b2ac
+Create Date: 2026-10-16 14:02:11.518230
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a8e5c0f7b21'
+down_revision = '1ff5c08b2ac'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'guardian_workers',
+        sa.Column('id', sa.String(255), primary_key=True),
+        sa.Column('started', sa.DateTime, nullable=False),
+        sa.Column('heartbeat', sa.DateTime, nullable=False),
+    )
+    op.create_index('ix_guardian_workers_heartbeat', 'guardian_workers',
+                    ['heartbeat'])
+
+
+def downgrade():
+    op.drop_index('ix_guardian_workers_heartbeat', 'guardian_workers')
+    op.drop_table('guardian_workers')
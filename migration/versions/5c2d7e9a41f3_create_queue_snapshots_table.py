@@ -0,0 +1,31 @@
+"""create queue snapshots table
+
+Revision ID: 5c2d7e9a41f3
+Revises: 3a8e5c0f7b21
+Create Date: 2026-10-16 21:12:40.284117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c2d7e9a41f3'
+down_revision = '3a8e5c0f7b21'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'queue_snapshots',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('version', sa.Integer, nullable=False),
+        sa.Column('digest', sa.String(40), nullable=False),
+        sa.Column('published', sa.DateTime, nullable=False),
+        sa.Column('data', sa.Text, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('queue_snapshots')
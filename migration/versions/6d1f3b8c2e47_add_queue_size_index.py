@@ -0,0 +1,23 @@
+"""add queue size index
+
+Revision ID: 6d1f3b8c2e47
+Revises: 5c2d7e9a41f3
+Create Date: 2026-10-16 23:05:12.518240
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6d1f3b8c2e47'
+down_revision = '5c2d7e9a41f3'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('ix_queues_size_name', 'queues', ['size', 'name'])
+
+
+def downgrade():
+    op.drop_index('ix_queues_size_name', table_name='queues')
@@ -0,0 +1,61 @@
+"""index guard lookups
+
+Add the indexes used by the guardian's and web views' lookups: bindings by
+queue (as part of a uniqueness constraint on bindings), queues by owner and
+Pulse user owners by Pulse user, with a primary key on the latter.
+
+Revision ID: 7e2a4c9d5b18
+Revises: 6d1f3b8c2e47
+Create Date: 2026-10-17 09:41:27.603914
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7e2a4c9d5b18'
+down_revision = '6d1f3b8c2e47'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+pulse_user_owners = sa.table('pulse_user_owners',
+                             sa.column('users_id', sa.Integer),
+                             sa.column('pulse_users_id', sa.Integer))
+
+
+def upgrade():
+    # Remove duplicate bindings and ownerships, keeping one of each.
+    op.execute(
+        'DELETE FROM bindings WHERE id NOT IN '
+        '(SELECT MIN(id) FROM bindings '
+        'GROUP BY queue_name, exchange, routing_key)')
+    bind = op.get_bind()
+    owners = bind.execute(sa.select([pulse_user_owners.c.users_id,
+                                     pulse_user_owners.c.pulse_users_id])
+                          .distinct()).fetchall()
+    op.execute(pulse_user_owners.delete())
+    if owners:
+        op.bulk_insert(pulse_user_owners,
+                       [{'users_id': users_id,
+                         'pulse_users_id': pulse_users_id}
+                        for users_id, pulse_users_id in owners])
+
+    op.create_unique_constraint('uq_bindings_queue_exchange_key', 'bindings',
+                                ['queue_name', 'exchange', 'routing_key'])
+    op.create_index('ix_queues_owner_id', 'queues', ['owner_id'])
+    op.create_primary_key('pulse_user_owners_pkey', 'pulse_user_owners',
+                          ['users_id', 'pulse_users_id'])
+    op.create_index('ix_pulse_user_owners_pulse_users_id',
+                    'pulse_user_owners', ['pulse_users_id'])
+
+
+def downgrade():
+    op.drop_index('ix_pulse_user_owners_pulse_users_id',
+                  table_name='pulse_user_owners')
+    op.drop_constraint('pulse_user_owners_pkey', 'pulse_user_owners',
+                       type_='primary')
+    op.drop_index('ix_queues_owner_id', table_name='queues')
+    op.drop_constraint('uq_bindings_queue_exchange_key', 'bindings',
+                       type_='unique')
@@ -38,11 +38,36 @@ email_from = os.getenv('EMAIL_FROM', 'Mozilla A-Team <auto-tools@mozilla.com>')
 email_smtp_server = os.getenv('EMAIL_SMTP_SERVER', 'smtp.mozilla.org')
 email_smtp_port = int(os.getenv('EMAIL_SMTP_PORT', 25))
 email_ssl = bool(int(os.getenv('EMAIL_SSL', 0)))
+# Emails sent by the guardian are queued (up to EMAIL_QUEUE_SIZE) and sent
+# in batches of up to EMAIL_BATCH_SIZE over a reused SMTP connection, which
+# is closed after EMAIL_IDLE_TIMEOUT seconds without emails.  Failed sends
+# are retried EMAIL_MAX_RETRIES times, waiting EMAIL_RETRY_DELAY seconds
+# before the first retry and doubling the delay every time.
+email_queue_size = int(os.getenv('EMAIL_QUEUE_SIZE', 100))
+email_batch_size = int(os.getenv('EMAIL_BATCH_SIZE', 20))
+email_idle_timeout = float(os.getenv('EMAIL_IDLE_TIMEOUT', 60))
+email_max_retries = int(os.getenv('EMAIL_MAX_RETRIES', 5))
+email_retry_delay = float(os.getenv('EMAIL_RETRY_DELAY', 1))
+# SMTP operations blocking for more than EMAIL_TIMEOUT seconds fail, so that a
+# hung server doesn't block sending emails forever.
+email_timeout = float(os.getenv('EMAIL_TIMEOUT', 60))
+# If non-zero, queue warnings, deletions and recoveries are collected for
+# EMAIL_DIGEST_WINDOW seconds and sent as a single digest email per
+# recipient, at most once every EMAIL_DIGEST_MIN_INTERVAL seconds.
+email_digest_window = int(os.getenv('EMAIL_DIGEST_WINDOW', 0))
+email_digest_min_interval = int(os.getenv('EMAIL_DIGEST_MIN_INTERVAL',
+                                          email_digest_window))
 
 # Database
 database_url = os.getenv('DATABASE_URL',
                          'postgresql://root@localhost/pulseguardian')
 pool_recycle_interval = int(os.getenv('POOL_RECYCLE_INTERVAL', 60))
+# Count the SQL statements run by every guard cycle and web request, logging
+# the statements run at least QUERY_REPEAT_THRESHOLD times (at most
+# QUERY_TOP_OFFENDERS of them), which usually reveal N+1 query patterns.
+query_counting = bool(int(os.getenv('QUERY_COUNTING', 0)))
+query_repeat_threshold = int(os.getenv('QUERY_REPEAT_THRESHOLD', 10))
+query_top_offenders = int(os.getenv('QUERY_TOP_OFFENDERS', 5))
 
 # RabbitMQ
 
@@ -56,6 +81,18 @@ rabbit_user = os.getenv('RABBIT_USER', 'guest')
 # Password of the RabbitMQ user.
 rabbit_password = os.getenv('RABBIT_PASSWORD', 'guest')
 
+# Management API HTTP client.  Connections are pooled and kept alive; the pool
+# size is the number of connections kept open to the management plugin.
+rabbit_pool_size = int(os.getenv('RABBIT_POOL_SIZE', 10))
+rabbit_connect_timeout = float(os.getenv('RABBIT_CONNECT_TIMEOUT', 5))
+rabbit_read_timeout = float(os.getenv('RABBIT_READ_TIMEOUT', 60))
+# Maximum number of management API requests made concurrently through
+# ``management.submit``.
+rabbit_max_concurrency = int(os.getenv('RABBIT_MAX_CONCURRENCY',
+                                       rabbit_pool_size))
+# Number of queues fetched per page of the queue listing (at most 500).
+rabbit_page_size = int(os.getenv('RABBIT_PAGE_SIZE', 500))
+
 # reserved users
 reserved_users_regex = os.getenv('RESERVED_USERS_REGEX', None)
 reserved_users_message = os.getenv('RESERVED_USERS_MESSAGE', None)
@@ -65,6 +102,66 @@ warn_queue_size = int(os.getenv('WARN_QUEUE_SIZE', 2000))
 del_queue_size = int(os.getenv('DEL_QUEUE_SIZE', 8000))
 polling_interval = int(os.getenv('POLLING_INTERVAL', 5))
 polling_max_interval = int(os.getenv('POLLING_MAX_INTERVAL', 300))
+# While no queue is growing towards a threshold, the polling interval is
+# doubled after every cycle, up to POLLING_QUIET_MAX_INTERVAL.  Queues that
+# may cross a threshold before the next cycle are polled on their own every
+# HOT_POLLING_INTERVAL seconds in between.
+polling_quiet_max_interval = int(os.getenv('POLLING_QUIET_MAX_INTERVAL', 30))
+hot_polling_interval = float(os.getenv('HOT_POLLING_INTERVAL', 1))
+# Growth rates are estimated from the last GROWTH_SAMPLES sizes of a queue
+# seen within GROWTH_WINDOW seconds.
+growth_samples = int(os.getenv('GROWTH_SAMPLES', 10))
+growth_window = int(os.getenv('GROWTH_WINDOW', 300))
+# Warn owners of queues projected to exceed the warning size before the next
+# cycle.  Optionally, delete queues past the warning size that are projected
+# to exceed the deletion size before they are polled again.
+predictive_warnings = bool(int(os.getenv('PREDICTIVE_WARNINGS', 1)))
+predictive_deletion = bool(int(os.getenv('PREDICTIVE_DELETION', 0)))
+# Queue sizes that changed without crossing a threshold are only written to
+# the database every QUEUE_SIZE_FLUSH_INTERVAL seconds (0 to write them on
+# every guard cycle).
+queue_size_flush_interval = int(os.getenv('QUEUE_SIZE_FLUSH_INTERVAL', 60))
+# Number of fetched queues buffered ahead of the reconciliation.
+guard_buffer_size = int(os.getenv('GUARD_BUFFER_SIZE', 1000))
+# Overgrown queues are deleted in bulk once per guard cycle, with at most
+# BULK_DELETE_CONCURRENCY deletions in flight and BULK_DELETE_RATE started
+# per second (0 for no limit).
+bulk_delete_concurrency = int(os.getenv('BULK_DELETE_CONCURRENCY', 4))
+bulk_delete_rate = float(os.getenv('BULK_DELETE_RATE', 20))
+# Threads and queue size of the stages running queue deletions and emails.
+enforcement_workers = int(os.getenv('ENFORCEMENT_WORKERS', 1))
+notification_workers = int(os.getenv('NOTIFICATION_WORKERS', 2))
+side_effect_queue_size = int(os.getenv('SIDE_EFFECT_QUEUE_SIZE', 1000))
+# Exchanges of unbound queues, named in notification emails, are looked up
+# with the management API and cached for EXCHANGE_CACHE_TTL seconds.
+exchange_cache_ttl = int(os.getenv('EXCHANGE_CACHE_TTL', 3600))
+exchange_cache_size = int(os.getenv('EXCHANGE_CACHE_SIZE', 10000))
+# Run several guardian processes, splitting the queues between them.  A
+# process that hasn't sent a heartbeat in WORKER_TIMEOUT seconds is considered
+# dead and its queues are taken over by the others.  Heartbeats are sent three
+# times per WORKER_TIMEOUT, however long guard cycles take.
+sharding = bool(int(os.getenv('GUARDIAN_SHARDING', 0)))
+worker_timeout = int(os.getenv('WORKER_TIMEOUT', 120))
+# Publish a snapshot of all queues after each guard cycle, from which the web
+# app lists queues without querying them.  Snapshots that haven't been
+# published for QUEUE_SNAPSHOT_MAX_AGE seconds, e.g. because the guardian is
+# down, are ignored, as are snapshots made stale by queue or Pulse user
+# deletions from the web app until the next one is published.
+queue_snapshots = bool(int(os.getenv('QUEUE_SNAPSHOTS', 1)))
+queue_snapshot_max_age = int(os.getenv('QUEUE_SNAPSHOT_MAX_AGE', 600))
+# Number of snapshot versions for which deleted queues are remembered, so that
+# dashboards can follow changes instead of reloading the whole listing.
+queue_snapshot_history = int(os.getenv('QUEUE_SNAPSHOT_HISTORY', 100))
+# Snapshots are rewritten in full whenever they change; larger than
+# QUEUE_SNAPSHOT_MAX_SIZE bytes (0 for no limit), they aren't published and
+# queues are listed from the database instead.
+queue_snapshot_max_size = int(os.getenv('QUEUE_SNAPSHOT_MAX_SIZE',
+                                        8 * 1024 * 1024))
+# Number of queues returned per page by /api/queues by default, and at most.
+api_queues_page_size = int(os.getenv('API_QUEUES_PAGE_SIZE', 100))
+api_queues_max_page_size = int(os.getenv('API_QUEUES_MAX_PAGE_SIZE', 1000))
+# Port on which the guardian serves its metrics on /metrics; 0 to disable.
+metrics_port = int(os.getenv('METRICS_PORT', 0))
 fake_account = os.getenv('FAKE_ACCOUNT', None)
 
 # Only used if at least one log path is specified above.
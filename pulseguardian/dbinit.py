@@ -8,9 +8,11 @@ import sys
 from pulseguardian import config, management as pulse_management
 from pulseguardian.model.base import db_session, init_db
 from pulseguardian.model.binding import Binding
+from pulseguardian.model.guardian_worker import GuardianWorker
 from pulseguardian.model.user import User
 from pulseguardian.model.pulse_user import PulseUser
 from pulseguardian.model.queue import Queue
+from pulseguardian.model.queue_snapshot import QueueSnapshot
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -37,6 +39,8 @@ def init_and_clear_db():
         db_session.delete(pulse_user)
     for user in User.query.all():
         db_session.delete(user)
+    QueueSnapshot.query.delete()
+    GuardianWorker.query.delete()
 
     db_session.commit()
 
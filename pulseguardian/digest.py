@@ -0,0 +1,85 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Coalescing of queue notifications into one digest email per recipient."""
+
+import threading
+import time
+from collections import OrderedDict
+
+# Kinds of queue events, in the order they appear in digests.
+DELETED = 'deleted'
+WARNING = 'overgrowing'
+BACK_TO_NORMAL = 'back to normal'
+KINDS = (DELETED, WARNING, BACK_TO_NORMAL)
+
+
+class NotificationDigest(object):
+    """Collects queue events per recipient address.
+
+    A recipient's digest becomes due ``window`` seconds after its first
+    collected event, but no sooner than ``min_interval`` seconds after the
+    previous digest sent to that recipient.  Events about the same queue
+    are coalesced, so a queue that was warned about and then deleted within
+    the same window only appears as deleted.
+    """
+
+    def __init__(self, window, min_interval=None):
+        self.window = window
+        self.min_interval = window if min_interval is None else min_interval
+        self._lock = threading.Lock()
+        # Address -> OrderedDict of queue name -> (kind, summary).
+        self._events = {}
+        # Address -> time of its oldest pending event.
+        self._first_event = {}
+        # Address -> time its last digest was sent.
+        self._last_sent = {}
+
+    def add(self, to_addrs, queue, kind, summary, now=None):
+        """Record an event of the given kind for ``queue``; ``summary`` is
+        the line describing it in the digest."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            for address in to_addrs:
+                events = self._events.setdefault(address, OrderedDict())
+                # Warnings and recoveries supersede each other and are
+                # superseded by a deletion.  Events following a deletion
+                # are about a new queue with the same name and are kept
+                # separately.
+                events.pop(queue, None)
+                if kind == DELETED:
+                    events[(queue, DELETED)] = (kind, summary)
+                else:
+                    events[queue] = (kind, summary)
+                self._first_event.setdefault(address, now)
+
+    def pop_due(self, now=None):
+        """Remove and return the digests that are due, as a list of
+        (address, {kind: [summary, ...]}) pairs."""
+        if now is None:
+            now = time.time()
+        due = []
+        with self._lock:
+            for address, first_event in self._first_event.items():
+                last_sent = self._last_sent.get(address)
+                if now < first_event + self.window:
+                    continue
+                if last_sent is not None and \
+                        now < last_sent + self.min_interval:
+                    continue
+
+                summaries = {}
+                for kind, summary in self._events.pop(address).values():
+                    summaries.setdefault(kind, []).append(summary)
+                del self._first_event[address]
+                self._last_sent[address] = now
+                due.append((address, summaries))
+
+            # Forget recipients that are no longer rate limited.
+            for address, last_sent in self._last_sent.items():
+                if (address not in self._first_event and
+                        now >= last_sent + self.min_interval):
+                    del self._last_sent[address]
+        return due
@@ -0,0 +1,140 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Queue growth tracking and polling schedule."""
+
+from collections import deque
+
+
+class GrowthTracker(object):
+    """Keeps the last few observed sizes of every queue and estimates how
+    fast each queue is growing from them.
+
+    :param max_samples: Number of samples kept per queue.
+    :param window: Samples older than this many seconds, relative to the
+                   queue's latest sample, are ignored.
+    """
+
+    def __init__(self, max_samples=10, window=300):
+        self.max_samples = max_samples
+        self.window = window
+        # Queue name -> (vhost, deque of (time, size)).
+        self._queues = {}
+
+    def observe(self, name, vhost, size, at):
+        if name not in self._queues:
+            self._queues[name] = (vhost, deque(maxlen=self.max_samples))
+        samples = self._queues[name][1]
+        if samples and at <= samples[-1][0]:
+            # Stale or duplicate data, e.g. from an overlapping poll.
+            return
+        samples.append((at, size))
+
+    def forget(self, name):
+        self._queues.pop(name, None)
+
+    def retain(self, names):
+        """Forget every queue but the given ones."""
+        names = set(names)
+        for name in self._queues.keys():
+            if name not in names:
+                del self._queues[name]
+
+    def queues(self):
+        """Yield the (vhost, name) of every tracked queue."""
+        for name, (vhost, samples) in self._queues.iteritems():
+            yield vhost, name
+
+    def _samples(self, name):
+        entry = self._queues.get(name)
+        if entry is None or not entry[1]:
+            return []
+        samples = entry[1]
+        latest = samples[-1][0]
+        return [s for s in samples if latest - s[0] <= self.window]
+
+    def size(self, name):
+        """Latest observed size, or None."""
+        samples = self._samples(name)
+        return samples[-1][1] if samples else None
+
+    def rate(self, name):
+        """Estimated growth rate in messages per second, fitted by least
+        squares over the recent samples; 0 if there are too few."""
+        samples = self._samples(name)
+        if len(samples) < 2:
+            return 0.0
+        n = float(len(samples))
+        mean_t = sum(t for t, _ in samples) / n
+        mean_s = sum(s for _, s in samples) / n
+        var = sum((t - mean_t) ** 2 for t, _ in samples)
+        if not var:
+            return 0.0
+        return sum((t - mean_t) * (s - mean_s) for t, s in samples) / var
+
+    def time_to(self, name, size):
+        """Seconds from the latest sample until the queue reaches ``size``
+        at its current rate; 0 if it already has, None if it isn't
+        growing."""
+        current = self.size(name)
+        if current is None:
+            return None
+        if current >= size:
+            return 0.0
+        rate = self.rate(name)
+        if rate <= 0:
+            return None
+        return (size - current) / rate
+
+
+class PollScheduler(object):
+    """Decides how often queues are polled based on their growth.
+
+    Queues projected to reach the next threshold before the next full
+    sweep are "hot" and polled individually in between sweeps.  While no
+    queue is projected to reach a threshold within ``max_interval``, the
+    sweep interval doubles, up to ``max_interval``; it goes back to
+    ``interval`` as soon as one is.
+
+    :param thresholds: Queue sizes at which the guardian acts, e.g. the
+                       warning and deletion sizes.
+    """
+
+    def __init__(self, tracker, thresholds, interval, max_interval):
+        self.tracker = tracker
+        self.thresholds = sorted(thresholds)
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.sweep_interval = interval
+
+    def _time_to_threshold(self, name):
+        size = self.tracker.size(name)
+        if size is None:
+            return None
+        for threshold in self.thresholds:
+            if size <= threshold:
+                return self.tracker.time_to(name, threshold + 1)
+        return None
+
+    def hot_queues(self, horizon=None):
+        """Return the (vhost, name) of the queues projected to cross a
+        threshold within ``horizon`` seconds (by default, the sweep
+        interval)."""
+        if horizon is None:
+            horizon = self.sweep_interval
+        hot = []
+        for vhost, name in self.tracker.queues():
+            eta = self._time_to_threshold(name)
+            if eta is not None and eta <= horizon:
+                hot.append((vhost, name))
+        return hot
+
+    def update(self):
+        """Recompute and return the sweep interval after a sweep."""
+        if self.hot_queues(self.max_interval):
+            self.sweep_interval = self.interval
+        else:
+            self.sweep_interval = min(self.sweep_interval * 2,
+                                      self.max_interval)
+        return self.sweep_interval
@@ -5,15 +5,249 @@
 import re
 import requests
 import socket
+import sys
+import threading
 import time
 import traceback
+from Queue import Full, Queue as FifoQueue
 
-from pulseguardian import config, management as pulse_management, mozdef
-from pulseguardian.model.base import init_db, db_session
-from pulseguardian.model.binding import Binding
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
+
+from pulseguardian import (config, digest, growth, listing,
+                           management as pulse_management, metrics, mozdef,
+                           sharding)
+from pulseguardian.cache import TTLCache
+from pulseguardian.model.base import init_db, db_session, QueryCount
+from pulseguardian.model.binding import BATCH_SIZE, Binding
 from pulseguardian.model.user import PulseUser, User
 from pulseguardian.model.queue import Queue
-from pulseguardian.sendemail import sendemail
+from pulseguardian.sendemail import MailDispatcher, sendemail
+
+fetch_duration = metrics.Histogram(
+    'pulseguardian_fetch_seconds',
+    'Time spent fetching queues and bindings from the management API.',
+    labels=('resource',))
+reconcile_duration = metrics.Histogram(
+    'pulseguardian_reconcile_seconds',
+    'Duration of monitor_queues passes, full sweeps or hot queue polls.',
+    labels=('pass',))
+commit_duration = metrics.Histogram(
+    'pulseguardian_db_commit_seconds',
+    'Duration of database commits.',
+    labels=('phase',))
+cycle_duration = metrics.Histogram(
+    'pulseguardian_cycle_seconds',
+    'Duration of guard cycles, excluding the wait for the next one.')
+queues_seen = metrics.Counter(
+    'pulseguardian_queues_seen_total',
+    'Queues reconciled, counted once per pass.')
+queues_warned = metrics.Counter(
+    'pulseguardian_queues_warned_total',
+    'Queues whose owners were warned.')
+queues_deleted = metrics.Counter(
+    'pulseguardian_queues_deleted_total',
+    'Queues deleted for exceeding, or being about to exceed, the deletion '
+    'size.',
+    labels=('reason',))
+
+
+class DatabaseSnapshot(object):
+    """In-memory view of the queues, Pulse users and bindings stored in
+    the database, loaded with a few bulk queries at the start of a guard
+    cycle so that reconciling against the management API data doesn't
+    issue one query per queue.
+
+    Queues are loaded along with their owners, the owners' owners and
+    their bindings, and Pulse users along with their owners; only the
+    queues named in ``queue_names`` are loaded if it is given.  If
+    ``shard`` is given, only the queues and Pulse users of that
+    ``sharding.ShardCoordinator``'s shard are loaded, their names being
+    queried first.  New queues and Pulse users created during the
+    cycle must be registered with ``add_queue`` and ``add_pulse_user`` so
+    that later lookups in the same cycle find them.  New bindings are
+    collected with ``add_binding`` and inserted all at once by
+    ``write_bindings``.  The fingerprints of the queues written are kept in
+    ``fingerprints`` until the cycle's changes are committed.
+    """
+
+    def __init__(self, queue_names=None, shard=None):
+        query = Queue.query.options(joinedload('owner').joinedload('owners'),
+                                    selectinload('bindings'))
+        # New queues' owners are looked up here and their owners emailed.
+        pulse_users = PulseUser.query.options(selectinload('owners'))
+        if shard is not None:
+            if queue_names is None:
+                queue_names = [name for name, in db_session.query(Queue.name)]
+            queue_names = [name for name in queue_names if shard.owns(name)]
+            pulse_users = _load_batches(
+                pulse_users, PulseUser.username,
+                [username for username, in db_session.query(
+                    PulseUser.username) if shard.owns_key(username)])
+        if queue_names is not None:
+            query = _load_batches(query, Queue.name, queue_names)
+        self.queues = {queue.name: queue for queue in query}
+        self.pulse_users = {pulse_user.username: pulse_user
+                            for pulse_user in pulse_users}
+        self._default_owner = None
+        # Bindings to insert, by queue name.
+        self._new_bindings = {}
+        self.fingerprints = {}
+
+    @property
+    def default_owner(self):
+        """The admin used as owner of Pulse users found on RabbitMQ but
+        unknown to PulseGuardian."""
+        if self._default_owner is None:
+            self._default_owner = User.query.filter(User.admin == True).first()
+        return self._default_owner
+
+    def add_queue(self, queue):
+        self.queues[queue.name] = queue
+
+    def remove_queue(self, queue):
+        self.queues.pop(queue.name, None)
+        self._new_bindings.pop(queue.name, None)
+        self.fingerprints.pop(queue.name, None)
+
+    def add_pulse_user(self, pulse_user):
+        self.pulse_users[pulse_user.username] = pulse_user
+
+    def add_binding(self, queue_name, exchange, routing_key):
+        self._new_bindings.setdefault(queue_name, set()).add(
+            (exchange, routing_key))
+
+    def write_bindings(self):
+        """Insert the new bindings of the queues still in the snapshot,
+        after flushing the session so that new queues exist."""
+        if not self._new_bindings:
+            return
+        db_session.flush()
+        Binding.insert_many(
+            (queue_name, exchange, routing_key)
+            for queue_name, bindings in self._new_bindings.iteritems()
+            for exchange, routing_key in bindings)
+        self._new_bindings = {}
+
+
+def _load_batches(query, column, values):
+    """Yield the results of ``query`` for the rows whose ``column`` is in
+    ``values``, querying ``BATCH_SIZE`` values at a time."""
+    values = list(values)
+    for start in xrange(0, len(values), BATCH_SIZE):
+        for row in query.filter(column.in_(values[start:start + BATCH_SIZE])):
+            yield row
+
+
+class QueueFetcher(threading.Thread):
+    """Producer stage of the guard pipeline.
+
+    Fetches all the bindings while streaming queues from the management
+    API into a bounded buffer, so that fetching overlaps with reconciling
+    the queues already received.  Errors are re-raised in the consuming
+    thread.
+    """
+
+    _done = object()
+
+    def __init__(self, buffer_size):
+        threading.Thread.__init__(self, name='queue-fetcher')
+        self.daemon = True
+        self._buffer = FifoQueue(buffer_size)
+        self._stopped = threading.Event()
+        self._bindings = pulse_management.submit(self._fetch_bindings)
+        self._error = None
+
+    @staticmethod
+    def _fetch_bindings():
+        with fetch_duration.time(resource='bindings'):
+            return pulse_management.BindingIndex(
+                pulse_management.iter_bindings())
+
+    def run(self):
+        try:
+            # Includes the time spent waiting for room in the buffer.
+            with fetch_duration.time(resource='queues'):
+                for queue_data in pulse_management.iter_queues():
+                    if not self._put(queue_data):
+                        return
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            self._put(self._done)
+
+    def _put(self, item):
+        # Give up if the consumer went away instead of blocking forever.
+        while not self._stopped.is_set():
+            try:
+                self._buffer.put(item, timeout=1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _raise_error(self):
+        if self._error:
+            exc_type, exc_value, exc_tb = self._error
+            raise exc_type, exc_value, exc_tb
+
+    def bindings(self):
+        """Wait for and return the ``BindingIndex`` of all bindings."""
+        return self._bindings.get()
+
+    def queues(self):
+        """Yield queue data as it is fetched."""
+        while True:
+            item = self._buffer.get()
+            if item is self._done:
+                break
+            yield item
+        self._raise_error()
+
+    def stop(self):
+        self._stopped.set()
+
+
+class SideEffectStage(object):
+    """Runs side effects of the guard loop (emails, queue deletions) on
+    background threads fed by a bounded queue, so that a slow one doesn't
+    hold up the reconciliation of every other queue.
+    """
+
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self._tasks = FifoQueue(queue_size)
+        for i in xrange(workers):
+            worker = threading.Thread(target=self._work,
+                                      name='{0}-{1}'.format(name, i))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule ``func``; blocks while the queue is full."""
+        self._tasks.put((func, args, kwargs))
+
+    def join(self):
+        """Wait for all scheduled side effects to be done."""
+        self._tasks.join()
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self._tasks.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                mozdef.log(
+                    mozdef.ERROR,
+                    mozdef.OTHER,
+                    'Side effect failed.',
+                    details={
+                        'stage': self.name,
+                        'message': traceback.format_exc(),
+                    },
+                )
+            finally:
+                self._tasks.task_done()
 
 
 class PulseGuardian(object):
@@ -28,10 +262,13 @@ class PulseGuardian(object):
     :param del_queue_size: Deletion threshold.
     :param on_warn: Callback called with a queue's name when it's warned.
     :param on_delete: Callback called with a queue's name when it's deleted.
+    :param digest_window: If non-zero, queue events are collected for this
+                          many seconds and emailed as one digest per
+                          recipient, see ``digest.NotificationDigest``.
     """
     def __init__(self, emails=True, warn_queue_size=config.warn_queue_size,
                  del_queue_size=config.del_queue_size, on_warn=None,
-                 on_delete=None):
+                 on_delete=None, digest_window=config.email_digest_window):
         if del_queue_size < warn_queue_size:
             raise ValueError("Deletion threshold can't be smaller than the "
                              "warning threshold.")
@@ -44,6 +281,40 @@ class PulseGuardian(object):
         self._polling_interval = config.polling_interval
         self._connection_error_notified = False
         self._unknown_error_notified = False
+        # Side-effect stages, only used by ``guard``; side effects are run
+        # synchronously otherwise.
+        self._enforcement = None
+        self._notifications = None
+        self._mail_dispatcher = None
+        # Exchanges of queues without bindings, looked up with the
+        # management API, by (vhost, queue name).
+        self._exchanges = TTLCache(config.exchange_cache_ttl,
+                                   config.exchange_cache_size)
+        self._digest = None
+        if digest_window:
+            self._digest = digest.NotificationDigest(
+                digest_window, config.email_digest_min_interval)
+        # Queues whose deletion was scheduled, mapped to the time it was
+        # done (None until then), so that data fetched before that time
+        # doesn't resurrect them.
+        self._deletions = {}
+        self._deletions_lock = threading.Lock()
+        # Fingerprint of each queue as last written to the database, see
+        # ``_fingerprint``, and when all queue sizes were last written.
+        self._fingerprints = {}
+        self._sizes_flushed_at = None
+        # Bindings of each queue as of the last ``clear_deleted_queues``.
+        self._cleared_bindings = {}
+        # Queue sizes seen in recent cycles, from which ``guard`` decides
+        # which queues to poll in between full sweeps.
+        self._growth = growth.GrowthTracker(config.growth_samples,
+                                            config.growth_window)
+        self._scheduler = growth.PollScheduler(
+            self._growth, (warn_queue_size, del_queue_size),
+            config.polling_interval, config.polling_quiet_max_interval)
+        # Set by ``guard`` when the queues are split between several
+        # guardian processes.
+        self._shard = None
 
     def _increase_interval(self):
         if self._polling_interval < config.polling_max_interval:
@@ -54,9 +325,33 @@ class PulseGuardian(object):
         self._connection_error_notified = False
         self._unknown_error_notified = False
 
-    def _sendemail(self, to_users, subject, text_data):
-        to_addrs = [user.email for user in to_users if user.email]
-        if to_addrs:
+    def _run_side_effect(self, stage, func, *args):
+        if stage:
+            stage.submit(func, *args)
+        else:
+            func(*args)
+
+    def _enforce(self, func, *args):
+        self._run_side_effect(self._enforcement, func, *args)
+
+    def _notify(self, func, *args):
+        self._run_side_effect(self._notifications, func, *args)
+
+    @staticmethod
+    def _email_addresses(users):
+        # Addresses are read up front since emails may be sent from
+        # another thread, which must not touch the database session.
+        return [user.email for user in users if user.email]
+
+    def _sendemail(self, to_addrs, subject, text_data):
+        if not to_addrs:
+            return
+        if self._mail_dispatcher:
+            self._mail_dispatcher.send(subject=subject,
+                                       from_addr=config.email_from,
+                                       to_addrs=to_addrs,
+                                       text_data=text_data)
+        else:
             sendemail(subject=subject,
                       from_addr=config.email_from,
                       to_addrs=to_addrs,
@@ -65,75 +360,154 @@ class PulseGuardian(object):
                       text_data=text_data,
                       server=config.email_smtp_server,
                       port=config.email_smtp_port,
-                      use_ssl=config.email_ssl)
+                      use_ssl=config.email_ssl,
+                      timeout=config.email_timeout)
 
-    def get_queue_bindings(self, all_bindings, queue_name):
-        """Extract the bindigns for just the named queue"""
-        return [x for x in all_bindings if
-                x["destination_type"] == "queue" and
-                x["destination"] == queue_name]
+    def get_queue_bindings(self, all_bindings, queue_data):
+        """Extract the bindings for just the given queue.
+
+        :param all_bindings: A ``BindingIndex`` of the broker's bindings.
+        :param queue_data: The queue's management API data.
+        """
+        return all_bindings.queue_bindings(queue_data['vhost'],
+                                           queue_data['name'])
+
+    def _size_band(self, size):
+        if size > self.del_queue_size:
+            return 2
+        if size > self.warn_queue_size:
+            return 1
+        return 0
+
+    def _fingerprint(self, queue_data, bindings):
+        """Summarize the data of a queue that matters to the guardian: the
+        thresholds its size is between, its durability and its bindings.
+        Size changes within the same thresholds are ignored."""
+        return (self._size_band(queue_data['messages']),
+                queue_data['durable'],
+                frozenset((b['source'], b['routing_key']) for b in bindings))
 
     def clear_deleted_queues(self, queues, all_bindings):
-        db_queues = Queue.query.all()
+        all_bindings = pulse_management.BindingIndex.wrap(all_bindings)
 
         # Filter queues that are in the database but no longer on RabbitMQ.
+        # The listing is paged through while queues come and go, so a
+        # deletion can shift a live queue out of it; queues missing from
+        # it are only cleared once confirmed gone one by one.
         alive_queues_names = {q['name'] for q in queues}
-        deleted_queues = {q for q in db_queues
-                          if q.name not in alive_queues_names}
-
-        # Delete those queues.
-        for queue in deleted_queues:
+        missing_queues = [name for name, in db_session.query(Queue.name)
+                          if name not in alive_queues_names]
+        exists = pulse_management.gather(
+            [pulse_management.submit(pulse_management.queue_exists,
+                                     config.rabbit_vhost, name)
+             for name in missing_queues],
+            return_exceptions=True)
+        deleted_queues = [name for name, found
+                          in zip(missing_queues, exists) if found is False]
+
+        # Delete those queues, along with their bindings, in bulk.
+        for name in deleted_queues:
             mozdef.log(
                 mozdef.NOTICE,
                 mozdef.OTHER,
                 'Queue no longer exists.',
-                details={'queuename': queue.name},
+                details={'queuename': name},
                 tags=['queue'],
             )
-            db_session.delete(queue)
+        Queue.delete_many(deleted_queues)
 
-        # Clean up bindings on queues that are not deleted.
-        for queue_name in alive_queues_names:
-            bindings = self.get_queue_bindings(all_bindings, queue_name)
-            self.clear_deleted_bindings(queue_name, bindings)
-
-        db_session.commit()
-
-    def clear_deleted_bindings(self, queue_name, queue_bindings):
-        db_bindings = Binding.query.filter(Binding.queue_name == queue_name)
+        # Clean up bindings on queues that are not deleted, skipping those
+        # whose bindings haven't changed since they were last cleaned up.
+        cleared_bindings = {}
+        changed_bindings = {}
+        for queue_data in queues:
+            bindings = self.get_queue_bindings(all_bindings, queue_data)
+            keys = frozenset((b['source'], b['routing_key'])
+                             for b in bindings)
+            if self._cleared_bindings.get(queue_data['name']) != keys:
+                changed_bindings[queue_data['name']] = keys
+            cleared_bindings[queue_data['name']] = keys
+        self.clear_deleted_bindings(changed_bindings)
+
+        with commit_duration.time(phase='clear'):
+            db_session.commit()
+        for name in deleted_queues:
+            self._fingerprints.pop(name, None)
+        self._cleared_bindings = cleared_bindings
 
-        # Filter bindings that are in the database but no longer on RabbitMQ.
-        alive_bindings_names = {Binding.as_string(b['source'],
-                                                  b['routing_key'])
-                                for b in queue_bindings}
-        deleted_bindings = {b for b in db_bindings
-                            if b.name not in alive_bindings_names}
+    def clear_deleted_bindings(self, alive_bindings):
+        """Delete the bindings of queues that are in the database but no
+        longer on RabbitMQ.
 
-        # Delete those bindings.
-        for binding in deleted_bindings:
-            mozdef.log(
-                mozdef.NOTICE,
-                mozdef.OTHER,
-                'Binding no longer exists.',
-                details={
-                    'queuename': queue_name,
-                    'binding': binding.name,
-                },
-                tags=['queue'],
-            )
-            db_session.delete(binding)
-
-    def update_queue_information(self, queue_data, all_bindings):
+        :param alive_bindings: The (exchange, routing key) pairs of the
+                               queues to clean up, by queue name.
+        """
+        # Only columns are loaded, a batch of queues at a time, and the
+        # bindings are deleted with as few statements.
+        deleted_ids = []
+        queue_names = list(alive_bindings)
+        for start in xrange(0, len(queue_names), BATCH_SIZE):
+            db_bindings = db_session.query(
+                Binding.id, Binding.queue_name, Binding.exchange,
+                Binding.routing_key).filter(Binding.queue_name.in_(
+                    queue_names[start:start + BATCH_SIZE]))
+            for binding_id, queue_name, exchange, routing_key in db_bindings:
+                if (exchange, routing_key) in alive_bindings[queue_name]:
+                    continue
+                mozdef.log(
+                    mozdef.NOTICE,
+                    mozdef.OTHER,
+                    'Binding no longer exists.',
+                    details={
+                        'queuename': queue_name,
+                        'binding': Binding.as_string(exchange, routing_key),
+                    },
+                    tags=['queue'],
+                )
+                deleted_ids.append(binding_id)
+        Binding.delete_many(deleted_ids)
+
+    def update_queue_information(self, queue_data, all_bindings,
+                                 snapshot=None, flush_size=True):
+        """Reconcile a queue's database record with its management API data.
+
+        Changes are added to the session but not committed; the caller
+        (normally ``monitor_queues``) commits once for the whole cycle,
+        after writing the new bindings collected in ``snapshot``.
+
+        :param all_bindings: A ``BindingIndex`` of the broker's bindings.
+        :param snapshot: The cycle's ``DatabaseSnapshot``.  A new one is
+                         loaded, and the queue's new bindings written, if
+                         not given.
+        :param flush_size: If False, the record is left untouched when the
+                           queue's fingerprint is the same as when it was
+                           last written, i.e. when only its size changed
+                           and without crossing a threshold.
+        """
         if 'messages' not in queue_data:
             # FIXME: We should do something here, probably delete the queue,
             # as it's in a weird state.  More investigation is required.
             # See bug 1066338.
             return None
 
+        all_bindings = pulse_management.BindingIndex.wrap(all_bindings)
+        if snapshot is None:
+            snapshot = DatabaseSnapshot()
+            queue = self.update_queue_information(queue_data, all_bindings,
+                                                  snapshot, flush_size)
+            snapshot.write_bindings()
+            return queue
+
         q_size, q_name, q_durable = (queue_data['messages'],
                                      queue_data['name'],
                                      queue_data['durable'])
-        queue = Queue.query.filter(Queue.name == q_name).first()
+        queue = snapshot.queues.get(q_name)
+        bindings = self.get_queue_bindings(all_bindings, queue_data)
+        fingerprint = self._fingerprint(queue_data, bindings)
+
+        if (queue is not None and not flush_size and
+                self._fingerprints.get(q_name) == fingerprint):
+            return queue
 
         # If the queue doesn't exist in the db, create it.
         if queue is None:
@@ -154,8 +528,7 @@ class PulseGuardian(object):
             else:
                 log_details['valid'] = True
                 owner_name = m.group(1)
-                owner = PulseUser.query.filter(
-                    PulseUser.username == owner_name).first()
+                owner = snapshot.pulse_users.get(owner_name)
                 log_details['ownername'] = owner_name
                 log_details['newowner'] = not owner
 
@@ -166,8 +539,9 @@ class PulseGuardian(object):
                     # PulseUser needs at least one owner as well, but since
                     # we have no way of knowing who really owns it, find the
                     # first admin, and set it to that.
-                    user = User.query.filter(User.admin == True).first()
-                    owner = PulseUser.new_user(owner_name, owners=user)
+                    owner = PulseUser.new_user(owner_name,
+                                               owners=snapshot.default_owner)
+                    snapshot.add_pulse_user(owner)
 
             mozdef.log(
                 mozdef.NOTICE,
@@ -177,101 +551,272 @@ class PulseGuardian(object):
                 tags=['queue'],
             )
             queue = Queue(name=q_name, owner=owner)
+            db_session.add(queue)
+            snapshot.add_queue(queue)
 
-        # add the queue bindings to the db.
-        bindings = self.get_queue_bindings(all_bindings, queue.name)
+        # Add the bindings missing from the db; they are inserted with
+        # those of the other queues.
+        db_bindings = {(b.exchange, b.routing_key) for b in queue.bindings}
         for binding in bindings:
-            db_binding = Binding.query.filter(
-                Binding.exchange == binding["source"],
-                Binding.routing_key == binding["routing_key"],
-                Binding.queue_name == queue.name
-                ).first()
-
-            if not db_binding:
-                # need to create the binding in the DB
-                binding = Binding(exchange=binding["source"],
-                                  routing_key=binding["routing_key"],
-                                  queue_name=queue.name)
-                db_session.add(binding)
-
-        # Update the saved queue size.
+            key = (binding["source"], binding["routing_key"])
+            if key not in db_bindings:
+                snapshot.add_binding(queue.name, *key)
+
+        # Update the saved queue size.  Unchanged values don't generate
+        # an UPDATE when the session is flushed.
         queue.size = q_size
         queue.durable = q_durable
-        db_session.add(queue)
-        db_session.commit()
+        # Only recorded once the changes are committed.
+        snapshot.fingerprints[q_name] = fingerprint
         return queue
 
-    def monitor_queues(self, queues, all_bindings):
+    def _delete_queue_record(self, queue, snapshot):
+        # Queues first seen in this cycle are still pending; flush them so
+        # they can be deleted like any other within the same transaction.
+        if inspect(queue).pending:
+            db_session.flush()
+        db_session.delete(queue)
+        snapshot.remove_queue(queue)
+        self._fingerprints.pop(queue.name, None)
+        self._growth.forget(queue.name)
+
+    def _projected_to_exceed(self, queue_name, size, horizon):
+        """Whether the queue is projected to hold more than ``size``
+        messages within ``horizon`` seconds, at its current growth rate."""
+        eta = self._growth.time_to(queue_name, size + 1)
+        return eta is not None and eta <= horizon
+
+    def monitor_queues(self, queues, all_bindings, fetched_at=None,
+                       partial=False):
+        """Reconcile the database with the queues reported by RabbitMQ and
+        enforce the warning and deletion thresholds.
+
+        The database is read with a handful of bulk queries up front and
+        all the resulting inserts, updates and deletes are written in a
+        single transaction at the end of the pass.  Queues whose size
+        changed without crossing a threshold are only written every
+        ``config.queue_size_flush_interval`` seconds.
+
+        :param queues: Queue data from the management API.  Any iterable
+                       works; it is consumed only once, so queues can be
+                       processed as they are received.
+        :param all_bindings: Bindings from the management API, either as a
+                             list or as a ``BindingIndex``.
+        :param fetched_at: When fetching ``queues`` started; defaults to now.
+        :param partial: True if ``queues`` is only some of the broker's
+                        queues, polled in between full sweeps.  Only the
+                        database records of those queues are loaded and
+                        queue sizes aren't flushed.
+        :returns: The name and vhost of every queue seen, to be passed on to
+                  ``clear_deleted_queues``.
+        """
+        started = time.time()
+        all_bindings = pulse_management.BindingIndex.wrap(all_bindings)
+        if partial:
+            queues = list(queues)
+            snapshot = DatabaseSnapshot([q['name'] for q in queues])
+        else:
+            snapshot = DatabaseSnapshot(shard=self._shard)
+        alive_queues = []
+        overgrown_queues = []
+        if fetched_at is None:
+            fetched_at = time.time()
+        flush_sizes = not partial and (
+            self._sizes_flushed_at is None or
+            fetched_at - self._sizes_flushed_at >=
+            config.queue_size_flush_interval)
+
+        with self._deletions_lock:
+            deletions = {name: deleted_at for name, deleted_at
+                         in self._deletions.items()
+                         if deleted_at is None or deleted_at >= fetched_at}
+            self._deletions = deletions.copy()
+
         for queue_data in queues:
+            alive_queues.append({'name': queue_data['name'],
+                                 'vhost': queue_data['vhost']})
+
+            # Don't resurrect a queue that is being deleted.
+            if queue_data['name'] in deletions:
+                continue
+
             # Updating the queue's information in the database (owner, size).
-            queue = self.update_queue_information(queue_data, all_bindings)
+            queue = self.update_queue_information(queue_data, all_bindings,
+                                                  snapshot, flush_sizes)
             if not queue:
                 continue
+            # The record's size may not be up to date.
+            size = queue_data['messages']
+            self._growth.observe(queue.name, queue_data['vhost'], size,
+                                 fetched_at)
+
+            # A queue past the warning size that grows fast enough to
+            # exceed the deletion size before it is polled again may be
+            # deleted right away rather than after overshooting.
+            predicted = (config.predictive_deletion and
+                         self.warn_queue_size < size <= self.del_queue_size
+                         and self._projected_to_exceed(
+                             queue.name, self.del_queue_size,
+                             config.hot_polling_interval))
 
             # If a queue is over the deletion size and ``unbounded`` is
             # False (the default), then delete it regardless of it having
             # an owner or not
             # If ``unbounded`` is True, then let it grow indefinitely.
-            if queue.size > self.del_queue_size and not queue.unbounded:
+            if ((size > self.del_queue_size or predicted) and
+                    not queue.unbounded):
+                details = self._queue_details_dict(queue_data)
+                details['predicted'] = bool(predicted)
+                queues_deleted.inc(
+                    reason='predicted' if predicted else 'size')
                 mozdef.log(
                     mozdef.NOTICE,
                     mozdef.OTHER,
                     'Deleting queue.',
-                    details=self._queue_details_dict(queue),
+                    details=details,
                     tags=['queue'],
                 )
                 if queue.owner and queue.owner.owners:
-                    self.deletion_email(queue.owner.owners, queue_data)
-                if self.on_delete:
-                    self.on_delete(queue.name)
-                pulse_management.delete_queue(vhost=queue_data['vhost'],
-                                              queue=queue.name)
-                db_session.delete(queue)
-                db_session.commit()
+                    self._notify(self.deletion_email,
+                                 self._email_addresses(queue.owner.owners),
+                                 queue_data,
+                                 self.get_queue_bindings(all_bindings,
+                                                         queue_data),
+                                 bool(predicted))
+                deletions[queue.name] = None
+                overgrown_queues.append(queue_data)
+                self._delete_queue_record(queue, snapshot)
                 continue
 
             if queue.owner is None or not queue.owner.owners:
                 continue
 
-            if queue.size > self.warn_queue_size and not queue.warned:
+            # Queues about to exceed the warning size before the next sweep
+            # are warned early, and aren't considered back to normal yet.
+            overgrowing = size > self.warn_queue_size or (
+                config.predictive_warnings and self._projected_to_exceed(
+                    queue.name, self.warn_queue_size,
+                    self._scheduler.sweep_interval))
+
+            if overgrowing and not queue.warned:
                 mozdef.log(
                     mozdef.NOTICE,
                     mozdef.OTHER,
                     'Queue-size warning.',
-                    details=self._queue_details_dict(queue),
+                    details=self._queue_details_dict(queue_data),
                     tags=['queue'],
                 )
                 queue.warned = True
+                queues_warned.inc()
                 if self.on_warn:
                     self.on_warn(queue.name)
-                self.warning_email(queue.owner.owners, queue_data)
-            elif queue.size <= self.warn_queue_size and queue.warned:
+                self._notify(self.warning_email,
+                             self._email_addresses(queue.owner.owners),
+                             queue_data,
+                             self.get_queue_bindings(all_bindings, queue_data))
+            elif not overgrowing and queue.warned:
                 # A previously warned queue got out of the warning threshold;
                 # its owner should not be warned again.
                 mozdef.log(
                     mozdef.NOTICE,
                     mozdef.OTHER,
                     'Queue-size recovered.',
-                    details=self._queue_details_dict(queue),
+                    details=self._queue_details_dict(queue_data),
                     tags=['queue'],
                 )
                 queue.warned = False
-                self.back_to_normal_email(queue.owner.owners, queue_data)
-
-            # Commit any changes to the queue.
-            db_session.add(queue)
+                self._notify(self.back_to_normal_email,
+                             self._email_addresses(queue.owner.owners),
+                             queue_data,
+                             self.get_queue_bindings(all_bindings, queue_data))
+
+        # Write all the changes of this pass at once.
+        with commit_duration.time(phase='monitor'):
+            snapshot.write_bindings()
             db_session.commit()
-
-    def _exchange_from_queue(self, queue_data):
-        exchange = 'could not be determined'
-        detailed_data = pulse_management.queue(vhost=queue_data['vhost'],
-                                               queue=queue_data['name'])
-        if detailed_data['incoming']:
-            exchange = detailed_data['incoming'][0]['exchange']['name']
+        self._fingerprints.update(snapshot.fingerprints)
+        if flush_sizes:
+            self._sizes_flushed_at = fetched_at
+
+        if overgrown_queues:
+            # Queues are only marked once their deletion is scheduled, so
+            # that a pass failing before this point doesn't leave them
+            # marked, and skipped, forever.
+            with self._deletions_lock:
+                for queue_data in overgrown_queues:
+                    self._deletions[queue_data['name']] = None
+            self._enforce(self._delete_queues, overgrown_queues)
+
+        queues_seen.inc(len(alive_queues))
+        reconcile_duration.observe(time.time() - started,
+                                   **{'pass': 'hot' if partial else 'sweep'})
+        return alive_queues
+
+    def _delete_queues(self, queues):
+        """Delete the given queues from RabbitMQ in one bulk operation."""
+        try:
+            if self.on_delete:
+                for queue_data in queues:
+                    self.on_delete(queue_data['name'])
+
+            results = pulse_management.delete_queues(
+                (queue_data['vhost'], queue_data['name'])
+                for queue_data in queues)
+            for vhost, name, error in results:
+                if error:
+                    mozdef.log(
+                        mozdef.ERROR,
+                        mozdef.OTHER,
+                        'Error deleting queue.',
+                        details={
+                            'queuename': name,
+                            'message': str(error),
+                        },
+                        tags=['queue'],
+                    )
+        finally:
+            deleted_at = time.time()
+            with self._deletions_lock:
+                for queue_data in queues:
+                    self._deletions[queue_data['name']] = deleted_at
+
+    def _exchange_from_queue(self, queue_data, bindings=None):
+        """Return the name of an exchange the queue receives messages from.
+
+        :param bindings: The queue's bindings, as returned by
+                         ``get_queue_bindings``.  The exchange is looked up
+                         with the management API, and cached, only if
+                         there are none.
+        """
+        if bindings:
+            return bindings[0]['source']
+
+        key = (queue_data['vhost'], queue_data['name'])
+        exchange = self._exchanges.get(key)
+        if exchange is None:
+            exchange = 'could not be determined'
+            detailed_data = pulse_management.queue(vhost=queue_data['vhost'],
+                                                   queue=queue_data['name'])
+            if detailed_data.get('incoming'):
+                exchange = detailed_data['incoming'][0]['exchange']['name']
+            self._exchanges.set(key, exchange)
         return exchange
 
-    def warning_email(self, users, queue_data):
-        exchange = self._exchange_from_queue(queue_data)
+    def warning_email(self, to_addrs, queue_data, bindings=None):
+        if not self.emails or not to_addrs:
+            return
+
+        exchange = self._exchange_from_queue(queue_data, bindings)
+
+        if self._digest:
+            self._digest.add(
+                to_addrs, queue_data['name'], digest.WARNING,
+                '"{0}" on exchange "{1}": {2} ready messages, {3} total '
+                'messages'.format(queue_data['name'], exchange,
+                                  queue_data['messages_ready'],
+                                  queue_data['messages']),
+                now=time.time())
+            return
 
         subject = 'Pulse warning: queue "{0}" is overgrowing'.format(
             queue_data['name'])
@@ -285,30 +830,59 @@ durable queues.
 '''.format(queue_data['name'], exchange, queue_data['messages_ready'],
            queue_data['messages'], self.del_queue_size)
 
-        if self.emails and users:
-            self._sendemail(
-                subject=subject, to_users=users, text_data=body)
-
-    def deletion_email(self, users, queue_data):
-        exchange = self._exchange_from_queue(queue_data)
-
+        self._sendemail(subject=subject, to_addrs=to_addrs, text_data=body)
+
+    def deletion_email(self, to_addrs, queue_data, bindings=None,
+                       predicted=False):
+        """:param predicted: True if the queue was deleted because it was
+                          projected to exceed the maximum size."""
+        if not self.emails or not to_addrs:
+            return
+
+        exchange = self._exchange_from_queue(queue_data, bindings)
+
+        if self._digest:
+            self._digest.add(
+                to_addrs, queue_data['name'], digest.DELETED,
+                '"{0}" on exchange "{1}": {2} messages{3}'.format(
+                    queue_data['name'], exchange, queue_data['messages'],
+                    ', growing too fast' if predicted else ''),
+                now=time.time())
+            return
+
+        if predicted:
+            reason = ('growing fast enough to exceed the maximum number of '
+                      'unread\nmessages before its next check')
+        else:
+            reason = 'exceeding the maximum number of unread messages'
         subject = 'Pulse warning: queue "{0}" has been deleted'.format(
             queue_data['name'])
         body = '''Your queue "{0}" on exchange "{1}" has been
-deleted after exceeding the maximum number of unread messages.  Upon deletion
+deleted after {4}.  Upon deletion
 there were {2} messages in the queue, out of a maximum {3} messages.
 
 Make sure your clients are running correctly and are cleaning up unused
 durable queues.
 '''.format(queue_data['name'], exchange, queue_data['messages'],
-           self.del_queue_size)
+           self.del_queue_size, reason)
 
-        if self.emails and users:
-            self._sendemail(
-                subject=subject, to_users=users, text_data=body)
+        self._sendemail(subject=subject, to_addrs=to_addrs, text_data=body)
 
-    def back_to_normal_email(self, users, queue_data):
-        exchange = self._exchange_from_queue(queue_data)
+    def back_to_normal_email(self, to_addrs, queue_data, bindings=None):
+        if not self.emails or not to_addrs:
+            return
+
+        exchange = self._exchange_from_queue(queue_data, bindings)
+
+        if self._digest:
+            self._digest.add(
+                to_addrs, queue_data['name'], digest.BACK_TO_NORMAL,
+                '"{0}" on exchange "{1}": {2} ready messages, {3} total '
+                'messages'.format(queue_data['name'], exchange,
+                                  queue_data['messages_ready'],
+                                  queue_data['messages']),
+                now=time.time())
+            return
 
         subject = 'Pulse warning: queue "{0}" is back to normal'.format(
             queue_data['name'])
@@ -317,9 +891,42 @@ now back to normal ({2} ready messages, {3} total messages).
 '''.format(queue_data['name'], exchange, queue_data['messages_ready'],
            queue_data['messages'], self.del_queue_size)
 
-        if self.emails and users:
-            self._sendemail(
-                subject=subject, to_users=users, text_data=body)
+        self._sendemail(subject=subject, to_addrs=to_addrs, text_data=body)
+
+    def send_digests(self):
+        """Email the queue event digests that are due."""
+        if not self._digest:
+            return
+
+        headings = {
+            digest.DELETED: 'Deleted after exceeding the maximum number of '
+                            'unread messages ({0}):'.format(
+                                self.del_queue_size),
+            digest.WARNING: 'Overgrowing; these queues will be automatically '
+                            'deleted when they\nexceed {0} messages:'.format(
+                                self.del_queue_size),
+            digest.BACK_TO_NORMAL: 'Back to normal:',
+        }
+
+        for address, summaries in self._digest.pop_due(now=time.time()):
+            counts = ['{0} {1}'.format(len(summaries[kind]), kind)
+                      for kind in digest.KINDS if kind in summaries]
+            subject = 'Pulse warning: queue digest ({0})'.format(
+                ', '.join(counts))
+            sections = ['{0}\n{1}'.format(
+                headings[kind],
+                '\n'.join('  - ' + summary for summary in summaries[kind]))
+                for kind in digest.KINDS if kind in summaries]
+            body = '''The following events occurred on your Pulse queues.
+
+{0}
+
+Make sure your clients are running correctly and are cleaning up unused
+durable queues.
+'''.format('\n\n'.join(sections))
+
+            self._sendemail(subject=subject, to_addrs=[address],
+                            text_data=body)
 
     def notify_connection_error(self):
         """Log and email to admin(s) that a connection error occurred.
@@ -352,8 +959,8 @@ Error:
             admins = list(User.query.filter_by(admin=True))
             subject = "PulseGuardian error: Can't connect to Pulse"
 
-            self._sendemail(
-                subject=subject, to_users=admins, text_data=errmsg)
+            self._notify(self._sendemail, self._email_addresses(admins),
+                         subject, errmsg)
             self._connection_error_notified = True
 
     def notify_unknown_error(self):
@@ -386,10 +993,19 @@ Error:
             admins = list(User.query.filter_by(admin=True))
             subject = "PulseGuardian error: Unknown error"
 
-            self._sendemail(
-                subject=subject, to_users=admins, text_data=errmsg)
+            self._notify(self._sendemail, self._email_addresses(admins),
+                         subject, errmsg)
             self._unknown_error_notified = True
 
+    def _discard_pass(self):
+        """Roll back whatever a failed pass left pending in the session.
+
+        Without this, the next query would flush or refuse the half-written
+        pass; the fingerprints no longer match the database either.
+        """
+        db_session.rollback()
+        self._fingerprints.clear()
+
     def guard(self):
         mozdef.log(
             mozdef.NOTICE,
@@ -397,6 +1013,34 @@ Error:
             'PulseGuardian started.',
         )
 
+        # Queue deletions and notifications run in their own stages so
+        # that a slow SMTP server can't delay threshold enforcement.
+        self._enforcement = SideEffectStage(
+            'enforcement', config.enforcement_workers,
+            config.side_effect_queue_size)
+        self._notifications = SideEffectStage(
+            'notifications', config.notification_workers,
+            config.side_effect_queue_size)
+        if self.emails:
+            self._mail_dispatcher = MailDispatcher(
+                server=config.email_smtp_server,
+                port=config.email_smtp_port,
+                username=config.email_account,
+                password=config.email_password,
+                use_ssl=config.email_ssl,
+                queue_size=config.email_queue_size,
+                batch_size=config.email_batch_size,
+                max_retries=config.email_max_retries,
+                retry_delay=config.email_retry_delay,
+                idle_timeout=config.email_idle_timeout,
+                timeout=config.email_timeout)
+            self._mail_dispatcher.start()
+        if config.sharding:
+            self._shard = sharding.ShardCoordinator(config.worker_timeout)
+            self._shard.start()
+        if config.metrics_port:
+            metrics.start_http_server(config.metrics_port)
+
         while True:
             mozdef.log(
                 mozdef.DEBUG,
@@ -404,54 +1048,142 @@ Error:
                 'Guard loop starting.',
             )
 
+            bindings = None
+            cycle_started = time.time()
+            queries = None
+            if config.query_counting:
+                queries = QueryCount('guard cycle').start()
             try:
-                queues = pulse_management.queues()
-                bindings = pulse_management.bindings()
-
-                mozdef.log(
-                    mozdef.DEBUG,
-                    mozdef.OTHER,
-                    'Fetched queue and binding data.',
-                )
+                if self._shard and self._shard.heartbeat():
+                    # Queues moved between workers; their records may
+                    # have been written by other workers meanwhile.
+                    self._fingerprints.clear()
+                    self._cleared_bindings.clear()
+
+                # Bindings and queues are fetched concurrently.  Bindings
+                # are needed in full up front; queues are reconciled as
+                # they are fetched by the producer thread.
+                fetched_at = time.time()
+                fetcher = QueueFetcher(config.guard_buffer_size)
+                fetcher.start()
+                try:
+                    bindings = fetcher.bindings()
 
-                if queues:
                     mozdef.log(
                         mozdef.DEBUG,
                         mozdef.OTHER,
-                        'Monitoring queues.',
+                        'Fetched binding data.  Monitoring queues.',
                     )
-                    self.monitor_queues(queues, bindings)
-
-                mozdef.log(
-                    mozdef.DEBUG,
-                    mozdef.OTHER,
-                    'Clearing deleted queues.',
-                )
-                self.clear_deleted_queues(queues, bindings)
+                    all_queues = []
+                    alive_queues = self.monitor_queues(
+                        self._owned_queues(fetcher.queues(), all_queues),
+                        bindings, fetched_at)
+                finally:
+                    fetcher.stop()
+
+                # Records of queues gone from the broker are cleared, and
+                # the listing snapshot published, by a single worker.
+                if not self._shard or self._shard.is_leader():
+                    mozdef.log(
+                        mozdef.DEBUG,
+                        mozdef.OTHER,
+                        'Clearing deleted queues.',
+                    )
+                    self.clear_deleted_queues(all_queues, bindings)
+                    if config.queue_snapshots:
+                        listing.publish()
+                self._growth.retain(q['name'] for q in alive_queues)
 
                 if (self._connection_error_notified or
                         self._unknown_error_notified):
                     self._reset_notification_error_params()
+                self._polling_interval = self._scheduler.update()
+                cycle_duration.observe(time.time() - cycle_started)
             except (requests.ConnectionError, socket.error):
+                self._discard_pass()
                 self.notify_connection_error()
                 self._increase_interval()
             except KeyboardInterrupt:
+                self._discard_pass()
+                if self._shard:
+                    self._shard.leave()
                 break
             except Exception:
+                self._discard_pass()
                 self.notify_unknown_error()
                 self._increase_interval()
 
+            if queries:
+                queries.stop()
+                queries.log()
+
+            self._notify(self.send_digests)
+
             mozdef.log(
                 mozdef.DEBUG,
                 mozdef.OTHER,
                 'Sleeping for {} seconds'.format(self._polling_interval),
             )
-            time.sleep(self._polling_interval)
+            self._poll_hot_queues(time.time() + self._polling_interval,
+                                  bindings)
+
+    def _owned_queues(self, queues, all_queues):
+        """Yield the queues handled by this worker, appending the name and
+        vhost of every queue to ``all_queues``."""
+        for queue_data in queues:
+            all_queues.append({'name': queue_data['name'],
+                               'vhost': queue_data['vhost']})
+            if not self._shard or self._shard.owns(queue_data['name']):
+                yield queue_data
+
+    def _poll_hot_queues(self, until, bindings):
+        """Wait until ``until``, polling the queues projected to cross a
+        threshold before then every ``config.hot_polling_interval``
+        seconds.
+
+        :param bindings: The last sweep's ``BindingIndex``, or None if the
+                         sweep failed, in which case nothing is polled.
+        """
+        while True:
+            now = time.time()
+            if now >= until:
+                return
+            hot = self._scheduler.hot_queues() if bindings else []
+            if not hot:
+                time.sleep(until - now)
+                return
+
+            time.sleep(min(config.hot_polling_interval, until - now))
+            fetched_at = time.time()
+            try:
+                results = pulse_management.gather(
+                    [pulse_management.submit(
+                        pulse_management.queue, vhost, name,
+                        columns=pulse_management.QUEUE_COLUMNS)
+                     for vhost, name in hot],
+                    return_exceptions=True)
+                # Queues deleted since the sweep fail to be fetched; they
+                # are cleared by the next one.
+                queues = [queue_data for queue_data in results
+                          if isinstance(queue_data, dict) and
+                          'messages' in queue_data]
+                self.monitor_queues(queues, bindings, fetched_at,
+                                    partial=True)
+            except Exception:
+                db_session.rollback()
+                mozdef.log(
+                    mozdef.ERROR,
+                    mozdef.OTHER,
+                    'Polling hot queues failed.',
+                    details={'message': traceback.format_exc()},
+                )
+                time.sleep(max(0, until - time.time()))
+                return
 
-    def _queue_details_dict(self, queue):
+    def _queue_details_dict(self, queue_data):
         return {
-            'queuename': queue.name,
-            'queuesize': queue.size,
+            'queuename': queue_data['name'],
+            'queuesize': queue_data['messages'],
             'warningthreshold': self.warn_queue_size,
             'deletionthreshold': self.del_queue_size,
         }
@@ -0,0 +1,286 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Queue listing snapshots shared by the guardian and the web app.
+
+After each cycle the guardian serializes every queue, with its owner and
+bindings, and the Pulse users of every user into a single row of the
+``queue_snapshots`` table, whose version is bumped when the content
+changed.  Web workers keep the latest snapshot in memory and only reload
+it when it changes, so listing queues doesn't query them, and clients can
+revalidate the listings they already have.
+
+Every queue in a snapshot carries the version in which it last changed,
+and the queues deleted in recent versions are kept as tombstones, so that
+clients can fetch only what changed since the version they last saw.
+"""
+
+import hashlib
+import json
+from collections import defaultdict, namedtuple
+from datetime import datetime
+
+from pulseguardian import config, mozdef
+from pulseguardian.model.base import db_session
+from pulseguardian.model.binding import Binding
+from pulseguardian.model.pulse_user import PulseUser
+from pulseguardian.model.queue import Queue
+from pulseguardian.model.queue_snapshot import QueueSnapshot
+from pulseguardian.model.user import User, pulse_user_owners
+
+# The snapshot is a single row.
+SNAPSHOT_ID = 1
+
+# Stand-ins for the model objects, as walked by the listing templates.
+ListedUser = namedtuple('ListedUser', 'email pulse_users')
+ListedPulseUser = namedtuple('ListedPulseUser', 'username queues')
+ListedQueue = namedtuple('ListedQueue', 'name owner size durable unbounded '
+                         'warned bindings version')
+ListedBinding = namedtuple('ListedBinding', 'exchange routing_key')
+
+# Latest snapshot loaded by this process.
+_loaded = None
+
+
+def collect():
+    """Return the snapshot data for the current state of the database:
+    every user's email and Pulse users, and every queue's name, owner,
+    size, flags and bindings, as lists to keep the snapshot compact.
+
+    Only columns are queried, since loading every queue and binding as
+    model objects would take much longer.
+    """
+    usernames = dict(db_session.query(PulseUser.id, PulseUser.username))
+    owned = defaultdict(list)
+    for user_id, pulse_user_id in db_session.query(
+            pulse_user_owners.c.users_id, pulse_user_owners.c.pulse_users_id):
+        owned[user_id].append(usernames[pulse_user_id])
+    bindings = defaultdict(list)
+    for queue_name, exchange, routing_key in db_session.query(
+            Binding.queue_name, Binding.exchange, Binding.routing_key):
+        bindings[queue_name].append([exchange, routing_key])
+
+    users = db_session.query(User.id, User.email).order_by(User.id)
+    queues = db_session.query(Queue.name, Queue.owner_id, Queue.size,
+                              Queue.durable, Queue.unbounded, Queue.warned) \
+        .order_by(Queue.name)
+    return {
+        'users': [[email, sorted(owned[user_id])]
+                  for user_id, email in users],
+        'queues': [[name, usernames.get(owner_id), size, bool(durable),
+                    bool(unbounded), bool(warned),
+                    sorted(bindings.get(name, []))]
+                   for name, owner_id, size, durable, unbounded, warned
+                   in queues],
+    }
+
+
+def _dumps(data):
+    return json.dumps(data, separators=(',', ':'), sort_keys=True)
+
+
+def track_changes(data, previous, version):
+    """Add to the ``data`` of snapshot ``version`` the version in which
+    each queue last changed and the tombstones of the queues deleted in
+    the last ``config.queue_snapshot_history`` versions, carried over from
+    the ``previous`` snapshot's data (None if there is none).
+
+    Also sets ``since``, the oldest version from which changes can be
+    followed, and ``users_version``, the version in which the users last
+    changed.
+    """
+    since = users_version = version
+    before = {}
+    deleted = {}
+    if previous:
+        since = max(previous['since'],
+                    version - config.queue_snapshot_history)
+        before = {queue[0]: queue for queue in previous['queues']}
+        deleted = {tombstone[0]: tombstone
+                   for tombstone in previous['deleted']
+                   if tombstone[2] > since}
+        if previous['users'] == data['users']:
+            users_version = previous['users_version']
+
+    for queue in data['queues']:
+        old = before.pop(queue[0], None)
+        queue.append(old[-1] if old and old[:-1] == queue else version)
+        deleted.pop(queue[0], None)
+    for name, old in before.iteritems():
+        # Name, owner and version of deletion.
+        deleted[name] = [name, old[1], version]
+
+    data['deleted'] = sorted(deleted.values())
+    data['since'] = since
+    data['users_version'] = users_version
+    return data
+
+
+def publish():
+    """Publish a snapshot of the database, bumping its version if it
+    changed since the last one.  Returns the current version, or None if
+    the snapshot is larger than ``config.queue_snapshot_max_size``, in
+    which case the previous one is marked stale instead.
+
+    The snapshot row is locked until the new version is committed, so that
+    concurrent publishers can't both turn the same version into different
+    next ones.
+    """
+    data = collect()
+    digest = hashlib.sha1(_dumps(data)).hexdigest()
+
+    snapshot = QueueSnapshot.query.with_for_update().get(SNAPSHOT_ID)
+    if snapshot is None:
+        snapshot = QueueSnapshot(id=SNAPSHOT_ID, version=0)
+        db_session.add(snapshot)
+    if snapshot.digest != digest:
+        previous = json.loads(snapshot.data) if snapshot.data else None
+        serialized = _dumps(track_changes(data, previous,
+                                          snapshot.version + 1))
+        if (config.queue_snapshot_max_size and
+                len(serialized) > config.queue_snapshot_max_size):
+            # The whole row is rewritten on every change; past this size,
+            # the web app lists queues from the database instead.
+            db_session.rollback()
+            mozdef.log(
+                mozdef.WARNING,
+                mozdef.OTHER,
+                'Queue snapshot too large to be published.',
+                details={
+                    'size': len(serialized),
+                    'maxsize': config.queue_snapshot_max_size,
+                },
+            )
+            mark_stale()
+            return None
+        snapshot.version += 1
+        snapshot.digest = digest
+        snapshot.data = serialized
+    # Also tells readers that the snapshot is still being kept up to date.
+    snapshot.published = datetime.utcnow()
+    db_session.commit()
+    return snapshot.version
+
+
+def mark_stale():
+    """Stop serving the current snapshot until the guardian publishes the
+    next one, e.g. after deleting queues, without collecting a new one."""
+    QueueSnapshot.query.filter(QueueSnapshot.id == SNAPSHOT_ID).update(
+        {'published': datetime.utcfromtimestamp(0)},
+        synchronize_session=False)
+    db_session.commit()
+
+
+class Snapshot(object):
+    """A loaded snapshot, indexed for listing queues."""
+
+    def __init__(self, version, digest, data):
+        self.version = version
+        self.digest = digest
+        self.since = data['since']
+        self.users_version = data['users_version']
+        self.users = [(email, pulse_users)
+                      for email, pulse_users in data['users']]
+        self._queues = defaultdict(list)
+        changed = []
+        for name, owner, size, durable, unbounded, warned, bindings, \
+                queue_version in data['queues']:
+            queue = ListedQueue(
+                name, owner, size, durable, unbounded, warned,
+                [ListedBinding(*binding) for binding in bindings],
+                queue_version)
+            self._queues[owner].append(queue)
+            changed.append(queue)
+        # Most recently changed first.
+        changed.sort(key=lambda queue: queue.version, reverse=True)
+        self._changed = changed
+        self._deleted = sorted(data['deleted'],
+                               key=lambda tombstone: tombstone[2],
+                               reverse=True)
+
+    def _pulse_users(self, usernames):
+        return [ListedPulseUser(username, self._queues.get(username, []))
+                for username in usernames]
+
+    def listing(self, user):
+        """Return the users and the queues without an owner to list for
+        ``user``, like ``web.listed_queues`` does from the database.
+
+        Admins see every user as of the snapshot.  Other users see their
+        own queues, their Pulse users being read from ``user`` so that new
+        ones show up right away.
+        """
+        if not user.admin:
+            usernames = sorted(pu.username for pu in user.pulse_users)
+            return [ListedUser(user.email, self._pulse_users(usernames))], []
+        users = [ListedUser(email, self._pulse_users(pulse_usernames))
+                 for email, pulse_usernames in self.users]
+        return users, self._queues.get(None, [])
+
+    def changes(self, user, since):
+        """Return the queues ``user`` may see that changed after version
+        ``since``, and the names of those deleted after it.
+
+        Returns None if the changes can't be followed from that version,
+        because it is too old or the users changed since, in which case
+        the whole listing must be reloaded.
+        """
+        if (since > self.version or since < self.since or
+                since < self.users_version):
+            return None
+
+        if user.admin:
+            visible = lambda owner: True
+        else:
+            owners = {pu.username for pu in user.pulse_users}
+            visible = owners.__contains__
+
+        changed = []
+        for queue in self._changed:
+            if queue.version <= since:
+                break
+            if visible(queue.owner):
+                changed.append(queue)
+        deleted = []
+        for name, owner, version in self._deleted:
+            if version <= since:
+                break
+            if visible(owner):
+                deleted.append(name)
+        return changed, deleted
+
+    def etag(self, user, *extra):
+        """Entity tag of the listing for ``user``, which changes with the
+        snapshot and with what the user may see in it."""
+        if user.admin:
+            scope = 'admin'
+        else:
+            scope = ','.join(sorted(pu.username for pu in user.pulse_users))
+        key = u'\0'.join([self.digest, user.email, scope] +
+                         [unicode(value) for value in extra])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def load(max_age=None):
+    """Return the latest published ``Snapshot``, or None if there is none
+    or it was last published more than ``max_age`` seconds ago."""
+    global _loaded
+
+    row = db_session.query(QueueSnapshot.digest, QueueSnapshot.published) \
+        .filter(QueueSnapshot.id == SNAPSHOT_ID).first()
+    if row is None:
+        return None
+    digest, published = row
+    if (max_age is not None and
+            (datetime.utcnow() - published).total_seconds() > max_age):
+        return None
+
+    loaded = _loaded
+    if loaded is None or loaded.digest != digest:
+        # Re-read the digest since the snapshot may have changed since.
+        version, digest, data = db_session.query(
+            QueueSnapshot.version, QueueSnapshot.digest,
+            QueueSnapshot.data).filter(QueueSnapshot.id == SNAPSHOT_ID).one()
+        loaded = _loaded = Snapshot(version, digest, json.loads(data))
+    return loaded
@@ -4,45 +4,240 @@
 
 """Wrapper functions around the RabbitMQ management plugin's REST API."""
 
+import codecs
+import itertools
 import json
 import logging
+import threading
+import time
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 from urllib import quote
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from pulseguardian import config, metrics
+
+request_duration = metrics.Histogram(
+    'pulseguardian_management_request_seconds',
+    'Duration of RabbitMQ management API requests.',
+    labels=('method', 'endpoint'))
+
+# Connection pool shared by every thread; each thread gets its own session
+# mounted on it since sessions themselves aren't thread safe.
+_adapter = None
+_adapter_lock = threading.Lock()
+_local = threading.local()
+
+# Worker threads running requests made through ``submit``.
+_workers = None
+_workers_lock = threading.Lock()
+
+# Size of the chunks read from streamed responses.
+STREAM_CHUNK_SIZE = 64 * 1024
 
-from pulseguardian import config
 
 class PulseManagementException(Exception):
     pass
 
 
-def _api_request(path, method='GET', data=None):
+def _get_session():
+    global _adapter
+
+    session = getattr(_local, 'session', None)
+    if session is None:
+        with _adapter_lock:
+            if _adapter is None:
+                _adapter = HTTPAdapter(pool_connections=1,
+                                       pool_maxsize=config.rabbit_pool_size,
+                                       pool_block=True)
+        session = requests.Session()
+        session.mount('http://', _adapter)
+        session.mount('https://', _adapter)
+        _local.session = session
+    return session
+
+
+def _get_workers():
+    global _workers
+
+    with _workers_lock:
+        if _workers is None:
+            _workers = ThreadPool(config.rabbit_max_concurrency)
+    return _workers
+
+
+def submit(func, *args, **kwargs):
+    """Call one of this module's functions on a shared pool of worker
+    threads, e.g. ``submit(delete_queue, vhost='/', queue='foo')``.
+
+    At most ``config.rabbit_max_concurrency`` calls run at once, over the
+    same pooled connections as synchronous calls.  Returns an
+    ``AsyncResult``; its ``get()`` method waits for and returns the result,
+    or raises the call's exception.
+    """
+    return _get_workers().apply_async(func, args, kwargs)
+
+
+def gather(results, return_exceptions=False):
+    """Wait for the given ``submit`` results and return their values, in
+    order.
+
+    :param return_exceptions: If True, exceptions are returned in place of
+                              the failed calls' results instead of being
+                              raised.
+    """
+    values = []
+    for result in results:
+        try:
+            values.append(result.get())
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            values.append(e)
+    return values
+
+
+def _api_request(path, method='GET', data=None, params=None, stream=False):
+    """Call the management API and return the decoded JSON response.
+
+    :param stream: If True and the response is a JSON array, return an
+                   iterator yielding the array's elements as they are
+                   received and decoded, instead of buffering the whole
+                   response.  Other responses are decoded as usual.
+    """
     if not config.rabbit_management_url:
         raise PulseManagementException("No RabbitMQ management URL "
                                        "configured.")
 
-    session = requests.Session()
+    session = _get_session()
     url = '{0}{1}'.format(config.rabbit_management_url, path)
+    # Only send a body when there is one: a stray "null" body on a GET
+    # would be left unread on the kept-alive connection.
+    body = json.dumps(data) if data is not None else None
     request = requests.Request(method, url,
                                auth=(config.rabbit_user,
                                      config.rabbit_password),
-                               data=json.dumps(data)).prepare()
+                               data=body, params=params).prepare()
     request.headers['Content-type'] = 'application/json'
-    response = session.send(request)
+    with request_duration.time(method=method, endpoint=path.split('/')[0]):
+        response = session.send(request, stream=stream,
+                                timeout=(config.rabbit_connect_timeout,
+                                         config.rabbit_read_timeout))
 
-    if response is None or not response.content:
+    if response is None:
+        return None
+
+    if stream:
+        return _streamed_response(response, method, path, data)
+
+    if not response.content:
         return None
 
     try:
         return response.json()
     except ValueError:
-        raise PulseManagementException(
-            "Error when calling '{0} {1}' with data={2}. "
-            "Received: {3}".format(method, path, data, response.content))
+        raise _decoding_error(method, path, data, response.content)
+
+
+def _decoding_error(method, path, data, content):
+    return PulseManagementException(
+        "Error when calling '{0} {1}' with data={2}. "
+        "Received: {3}".format(method, path, data, content))
+
+
+def _streamed_response(response, method, path, data):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = (decoder.decode(chunk) for chunk
+              in response.iter_content(STREAM_CHUNK_SIZE))
+
+    # Look at the first non-whitespace character to tell arrays apart.
+    head = u''
+    for chunk in chunks:
+        head += chunk
+        if head.strip():
+            break
+    head = head.lstrip()
+
+    if head.startswith('['):
+        return _iter_streamed_array(response, method, path, data,
+                                    itertools.chain([head[1:]], chunks))
+
+    content = head + u''.join(chunks)
+    if not content:
+        return None
+    try:
+        return json.loads(content)
+    except ValueError:
+        raise _decoding_error(method, path, data, content)
+
+
+def _iter_streamed_array(response, method, path, data, chunks):
+    try:
+        for value in _iter_json_array(chunks):
+            yield value
+    except ValueError as e:
+        raise _decoding_error(method, path, data, e)
+    finally:
+        response.close()
+
+
+def _iter_json_array(chunks):
+    """Incrementally decode a JSON array, yielding its elements.
+
+    :param chunks: An iterator of text chunks, starting just after the
+                   array's opening bracket.
+    """
+    decoder = json.JSONDecoder()
+    buf = u''
+    pos = 0
+    eof = False
+
+    while True:
+        # Skip whitespace and the separators between elements.
+        while pos < len(buf) and buf[pos] in u' \t\r\n,':
+            pos += 1
+
+        if pos < len(buf):
+            if buf[pos] == u']':
+                return
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Most likely an element split across chunks.
+                pass
+            else:
+                # A value is only known to be complete once followed by a
+                # separator: a number cut short ("1." or "1e" of "1.5" or
+                # "1e3") may still decode as a shorter one.
+                after = end
+                while after < len(buf) and buf[after] in u' \t\r\n':
+                    after += 1
+                if eof or (after < len(buf) and buf[after] in u',]'):
+                    yield value
+                    pos = end
+                    continue
+
+        if eof:
+            raise ValueError("Truncated JSON array: {0}".format(
+                buf[pos:pos + 100]))
+
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            eof = True
+        else:
+            buf = buf[pos:] + chunk
+            pos = 0
 
 
 # Queues
 
+# Queue fields used by the guardian.
+QUEUE_COLUMNS = ('name', 'vhost', 'messages', 'messages_ready', 'durable')
+
+
 def queues(vhost=None):
     if vhost:
         vhost = quote(vhost, '')
@@ -51,10 +246,57 @@ def queues(vhost=None):
         return _api_request('queues')
 
 
-def queue(vhost, queue):
+def iter_queues(vhost=None, columns=QUEUE_COLUMNS, page_size=None):
+    """Yield queues one page at a time, with only the given columns and
+    without message rate statistics.
+
+    Falls back to a single unpaginated request, decoded as it is received,
+    on RabbitMQ versions that don't support pagination.
+    """
+    if vhost:
+        path = 'queues/{0}'.format(quote(vhost, ''))
+    else:
+        path = 'queues'
+
+    params = {
+        'columns': ','.join(columns),
+        'disable_stats': 'true',
+        'enable_queue_totals': 'true',
+        'page_size': page_size or config.rabbit_page_size,
+        'sort': 'name',
+    }
+    page = 1
+    while True:
+        params['page'] = page
+        result = _api_request(path, params=params, stream=True)
+        if result is None:
+            return
+        if not isinstance(result, dict):
+            # Unpaginated list, decoded as it is received.
+            for queue_data in result:
+                yield queue_data
+            return
+
+        for queue_data in result['items']:
+            yield queue_data
+        if page >= result['page_count']:
+            return
+        page += 1
+
+
+def queue(vhost, queue, columns=None):
     vhost = quote(vhost, '')
     queue = quote(queue, '')
-    return _api_request('queues/{0}/{1}'.format(vhost, queue))
+    params = {'columns': ','.join(columns)} if columns else None
+    return _api_request('queues/{0}/{1}'.format(vhost, queue), params=params)
+
+
+def queue_exists(vhost, name):
+    """Whether the queue exists, checked with a request for that queue
+    alone.  Only a "not found" reply counts as the queue being gone."""
+    queue_data = queue(vhost, name, columns=('name',))
+    return not (isinstance(queue_data, dict) and
+                queue_data.get('error') == 'Object Not Found')
 
 
 def queue_bindings(vhost, queue):
@@ -71,15 +313,112 @@ def delete_queue(vhost, queue):
                       method='DELETE')
 
 
+class RateLimiter(object):
+    """Spaces out calls to ``wait`` so that, across all threads, at most
+    ``rate`` of them return per second.  A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def delete_queues(queues, concurrency=None, rate=None):
+    """Delete many queues in parallel, through ``submit``.
+
+    :param queues: (vhost, queue name) pairs.
+    :param concurrency: Maximum number of deletions in flight; defaults to
+                        ``config.bulk_delete_concurrency``.  Deletions also
+                        count towards ``config.rabbit_max_concurrency``.
+    :param rate: Maximum number of deletions started per second; defaults
+                 to ``config.bulk_delete_rate``.  0 means no limit.
+    :returns: A list of (vhost, queue name, exception) tuples, in the order
+              of ``queues``; the exception is None if the deletion
+              succeeded.
+    """
+    queues = list(queues)
+    if not queues:
+        return []
+
+    if concurrency is None:
+        concurrency = config.bulk_delete_concurrency
+    if rate is None:
+        rate = config.bulk_delete_rate
+    limiter = RateLimiter(rate)
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def delete(vhost, queue):
+        try:
+            delete_queue(vhost, queue)
+        except Exception as e:
+            return vhost, queue, e
+        finally:
+            slots.release()
+        return vhost, queue, None
+
+    results = []
+    for vhost, queue in queues:
+        slots.acquire()
+        limiter.wait()
+        results.append(submit(delete, vhost, queue))
+    return gather(results)
+
+
 def delete_all_queues():
-    for queue_data in queues():
-        delete_queue(queue_data['vhost'], queue_data['name'])
+    queues = [(queue_data['vhost'], queue_data['name']) for queue_data
+              in iter_queues(columns=('name', 'vhost'))]
+    for vhost, queue, error in delete_queues(queues):
+        if error:
+            raise error
 
 
 def bindings():
     """All bindings for all queues"""
-    bindings = _api_request('bindings')
-    return [b for b in bindings if b["source"]]
+    return list(iter_bindings())
+
+
+def iter_bindings():
+    """Yield all bindings for all queues as they are received."""
+    for binding in _api_request('bindings', stream=True) or []:
+        if binding["source"]:
+            yield binding
+
+
+class BindingIndex(object):
+    """Bindings indexed by (vhost, destination queue).
+
+    Built once per guard cycle from the result of ``bindings()`` so that
+    looking up a queue's bindings doesn't scan every binding on the broker.
+    """
+
+    def __init__(self, bindings):
+        self._bindings = defaultdict(list)
+        for binding in bindings:
+            if binding["destination_type"] == "queue":
+                key = (binding["vhost"], binding["destination"])
+                self._bindings[key].append(binding)
+
+    @classmethod
+    def wrap(cls, bindings):
+        """Return ``bindings`` as a ``BindingIndex``, building one if it is
+        a plain list of bindings."""
+        if isinstance(bindings, cls):
+            return bindings
+        return cls(bindings)
+
+    def queue_bindings(self, vhost, queue):
+        return self._bindings.get((vhost, queue), [])
 
 
 # Users
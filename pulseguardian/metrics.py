@@ -0,0 +1,169 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""In-process metrics, exposed in the Prometheus text format."""
+
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+from SocketServer import ThreadingMixIn
+
+# Content type of ``exposition()``.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds, in seconds, of the histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+# All metrics created in this process, by name.
+registry = {}
+
+
+def _label_string(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                           .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """Monotonically increasing count, optionally split by a set of labels.
+    """
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        registry[name] = self
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self):
+        """Return a copy of the counts, by label values."""
+        with self._lock:
+            return dict(self._values)
+
+    def exposition(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.description),
+                 '# TYPE {0} counter'.format(self.name)]
+        for key, value in sorted(self.values().items()):
+            lines.append('{0}{1} {2}'.format(
+                self.name, _label_string(self.labels, key),
+                _format_value(value)))
+        return lines
+
+
+class Histogram(object):
+    """Cumulative histogram of observed values (typically durations),
+    optionally split by a set of labels.
+    """
+
+    def __init__(self, name, description, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # Per label values: (bucket counts, sum, count).
+        self._values = {}
+        registry[name] = self
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the ``with`` block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def values(self):
+        """Return a copy of the collected values, as a dict mapping label
+        values to (bucket counts, sum, count) tuples."""
+        with self._lock:
+            return {key: (list(counts), total, count)
+                    for key, (counts, total, count) in self._values.items()}
+
+    def exposition(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.description),
+                 '# TYPE {0} histogram'.format(self.name)]
+        for key, (counts, total, count) in sorted(self.values().items()):
+            bounds = list(self.buckets) + [float('inf')]
+            for bound, bucket_count in zip(bounds, counts + [count]):
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name,
+                    _label_string(self.labels, key,
+                                  [('le', _format_value(bound))]),
+                    _format_value(bucket_count)))
+            labels = _label_string(self.labels, key)
+            lines.append('{0}_sum{1} {2}'.format(self.name, labels,
+                                                 _format_value(total)))
+            lines.append('{0}_count{1} {2}'.format(self.name, labels,
+                                                   _format_value(count)))
+        return lines
+
+
+def exposition():
+    """Render every metric of the registry in the Prometheus text format."""
+    lines = []
+    for name in sorted(registry):
+        lines.extend(registry[name].exposition())
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, host=''):
+    """Serve the metrics on ``/metrics`` from a background thread.
+    Returns the server."""
+    server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
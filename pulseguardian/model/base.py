@@ -3,10 +3,12 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import sys
+import threading
 import time
+from collections import Counter
 sys.path.append('..')
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
@@ -39,3 +41,89 @@ def init_db():
             time.sleep(5)
         else:
             break
+
+
+# Query counting.  Statements executed by a thread are counted by every
+# ``QueryCount`` it has started, so that N+1 query patterns show up.
+
+_counting = threading.local()
+_listening = False
+_listen_lock = threading.Lock()
+
+
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    for query_count in getattr(_counting, 'active', ()):
+        query_count.statements[statement] += 1
+
+
+class QueryCount(object):
+    """Counts the statements executed on the engine by the current thread
+    between ``start`` and ``stop``, or within a ``with`` block.
+
+    :param label: Describes what is counted, e.g. "guard cycle"; used when
+                  logging.
+    """
+
+    def __init__(self, label=None):
+        global _listening
+
+        self.label = label
+        self.statements = Counter()
+        with _listen_lock:
+            if not _listening:
+                event.listen(engine, 'before_cursor_execute',
+                             _count_statement)
+                _listening = True
+
+    @property
+    def total(self):
+        return sum(self.statements.itervalues())
+
+    def start(self):
+        if not hasattr(_counting, 'active'):
+            _counting.active = []
+        _counting.active.append(self)
+        return self
+
+    def stop(self):
+        active = getattr(_counting, 'active', [])
+        if self in active:
+            active.remove(self)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def repeated(self, threshold=2, limit=None):
+        """Return the (statement, count) of the statements executed at
+        least ``threshold`` times, most repeated first."""
+        return [(statement, count)
+                for statement, count in self.statements.most_common(limit)
+                if count >= threshold]
+
+    def log(self, threshold=None, limit=None, details=None):
+        """Log the number of statements, and the most repeated ones if
+        any were executed at least ``threshold`` times."""
+        if threshold is None:
+            threshold = config.query_repeat_threshold
+        if limit is None:
+            limit = config.query_top_offenders
+
+        details = dict(details or {}, queries=self.total,
+                       distinct_queries=len(self.statements))
+        if self.label:
+            details['counted'] = self.label
+        offenders = self.repeated(threshold, limit)
+        if not offenders:
+            mozdef.log(mozdef.DEBUG, mozdef.OTHER, 'Queries counted.',
+                       details=details)
+            return
+
+        details['repeated'] = ' | '.join(
+            '{0}x {1}'.format(count, ' '.join(statement.split()))
+            for statement, count in offenders)
+        mozdef.log(mozdef.WARNING, mozdef.OTHER, 'Repeated queries.',
+                   details=details)
@@ -2,9 +2,14 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, ForeignKey, Integer, String, UniqueConstraint
+from sqlalchemy.dialects import postgresql
 
-from pulseguardian.model.base import Base
+from pulseguardian.model.base import Base, db_session, engine
+
+# Rows or ids written per statement by ``insert_many`` and ``delete_many``,
+# within SQLite's default limit of 999 parameters per statement.
+BATCH_SIZE = 500
 
 
 class Binding(Base):
@@ -15,6 +20,10 @@ class Binding(Base):
     routing_key = Column(String(255))
     queue_name = Column(String(255), ForeignKey('queues.name'))
 
+    # Also indexes the bindings by queue, looked up every guard cycle.
+    __table_args__ = (UniqueConstraint('queue_name', 'exchange', 'routing_key',
+                                       name='uq_bindings_queue_exchange_key'),)
+
     @property
     def name(self):
         return Binding.as_string(self.exchange, self.routing_key)
@@ -25,6 +34,42 @@ class Binding(Base):
         # be consistent with the string format for comparisons.
         return "{}-{}".format(exchange, routing_key)
 
+    @staticmethod
+    def insert_many(rows):
+        """Add bindings given as (queue name, exchange, routing key) tuples,
+        skipping those already in the database.
+
+        On PostgreSQL they are written with multi-row ``INSERT ... ON
+        CONFLICT DO NOTHING`` statements, on SQLite and MySQL with
+        ``INSERT OR IGNORE`` and ``INSERT IGNORE``.
+        """
+        table = Binding.__table__
+        rows = [{'queue_name': queue_name, 'exchange': exchange,
+                 'routing_key': routing_key}
+                for queue_name, exchange, routing_key in rows]
+        if not rows:
+            return
+        if engine.dialect.name != 'postgresql':
+            db_session.execute(
+                table.insert()
+                .prefix_with('OR IGNORE', dialect='sqlite')
+                .prefix_with('IGNORE', dialect='mysql'), rows)
+            return
+        for start in xrange(0, len(rows), BATCH_SIZE):
+            db_session.execute(
+                postgresql.insert(table)
+                .values(rows[start:start + BATCH_SIZE])
+                .on_conflict_do_nothing(
+                    index_elements=['queue_name', 'exchange', 'routing_key']))
+
+    @staticmethod
+    def delete_many(ids):
+        """Delete the bindings with the given ids."""
+        ids = list(ids)
+        for start in xrange(0, len(ids), BATCH_SIZE):
+            db_session.execute(Binding.__table__.delete().where(
+                Binding.id.in_(ids[start:start + BATCH_SIZE])))
+
     def __repr__(self):
         return "<Binding(exchange='{0}', routing_key='{1}')>".format(
             self.exchange,
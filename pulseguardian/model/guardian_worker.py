@@ -0,0 +1,24 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from sqlalchemy import Column, DateTime, String
+
+from pulseguardian.model.base import Base
+
+
+class GuardianWorker(Base):
+    """A running guardian process, when guardians are sharded.  Workers
+    whose heartbeat is too old are considered dead."""
+
+    __tablename__ = 'guardian_workers'
+
+    id = Column(String(255), primary_key=True)
+    started = Column(DateTime, nullable=False)
+    heartbeat = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<GuardianWorker(id='{0}', heartbeat='{1}')>".format(
+            self.id, self.heartbeat)
+
+    __str__ = __repr__
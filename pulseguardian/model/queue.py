@@ -2,18 +2,19 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, String
 from sqlalchemy.orm import relationship
 
-from pulseguardian.model.base import Base
-from pulseguardian.model.binding import Binding
+from pulseguardian.model.base import Base, db_session
+from pulseguardian.model.binding import BATCH_SIZE, Binding
 
 
 class Queue(Base):
     __tablename__ = 'queues'
 
     name = Column(String(255), primary_key=True)
-    owner_id = Column(Integer, ForeignKey('pulse_users.id'), nullable=True)
+    owner_id = Column(Integer, ForeignKey('pulse_users.id'), nullable=True,
+                      index=True)
     size = Column(Integer)
     # whether the queue can grow beyond the deletion size without being deleted
     unbounded = Column(Boolean, default=False)
@@ -23,6 +24,21 @@ class Queue(Base):
     durable = Column(Boolean, nullable=False, default=False)
     bindings = relationship(Binding, cascade='save-update, merge, delete')
 
+    # Pages through the queues by size for /api/queues.
+    __table_args__ = (Index('ix_queues_size_name', 'size', 'name'),)
+
+    @staticmethod
+    def delete_many(names):
+        """Delete the queues with the given names and their bindings,
+        without loading them."""
+        names = list(names)
+        for start in xrange(0, len(names), BATCH_SIZE):
+            batch = names[start:start + BATCH_SIZE]
+            db_session.execute(Binding.__table__.delete().where(
+                Binding.queue_name.in_(batch)))
+            db_session.execute(Queue.__table__.delete().where(
+                Queue.name.in_(batch)))
+
     def __repr__(self):
         return "<Queue(name='{0}', owner='{1}')>".format(self.name, self.owner)
 
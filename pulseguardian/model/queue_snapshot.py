@@ -0,0 +1,27 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from sqlalchemy import Column, DateTime, Integer, String, Text
+
+from pulseguardian.model.base import Base
+
+
+class QueueSnapshot(Base):
+    """Serialized state of all queues, published by the guardian for the
+    web app; see ``pulseguardian.listing``.  The version is bumped every
+    time the content changes."""
+
+    __tablename__ = 'queue_snapshots'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    digest = Column(String(40), nullable=False)
+    published = Column(DateTime, nullable=False)
+    data = Column(Text, nullable=False)
+
+    def __repr__(self):
+        return "<QueueSnapshot(version='{0}', published='{1}')>".format(
+            self.version, self.published)
+
+    __str__ = __repr__
@@ -9,14 +9,18 @@ from pulseguardian.model.base import Base, db_session
 from pulseguardian.model.pulse_user import PulseUser
 
 
+# Keyed by user; the index looks up the owners of Pulse users.
 pulse_user_owners = Table('pulse_user_owners',
                           Base.metadata,
                           Column('users_id',
                                  Integer,
-                                 ForeignKey('users.id')),
+                                 ForeignKey('users.id'),
+                                 primary_key=True),
                           Column('pulse_users_id',
                                  Integer,
-                                 ForeignKey('pulse_users.id')))
+                                 ForeignKey('pulse_users.id'),
+                                 primary_key=True,
+                                 index=True))
 
 
 class User(Base):
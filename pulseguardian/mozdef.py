@@ -6,6 +6,7 @@ import datetime
 import json
 import os
 import sys
+import threading
 
 import pulseguardian.config
 
@@ -30,6 +31,9 @@ OTHER = 'Other'
 SHUTDOWN = 'Shutdown'
 STARTUP = 'Startup'
 
+# Keeps log lines written from different threads from interleaving.
+_output_lock = threading.Lock()
+
 
 def log(sev, cat, summary, details=None, tags=None):
     now = datetime.datetime.utcnow()
@@ -52,4 +56,6 @@ def log(sev, cat, summary, details=None, tags=None):
         'timestamp': now.strftime('%Y-%m-%dT%H:%M:%S+00:00'),
     }
 
-    print json.dumps(msg)
+    line = json.dumps(msg)
+    with _output_lock:
+        print line
@@ -3,16 +3,26 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import smtplib
+import socket
 import sys
+import threading
+import time
+import traceback
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from Queue import Empty, Queue as FifoQueue
+
+from pulseguardian import metrics, mozdef
+
+send_duration = metrics.Histogram(
+    'pulseguardian_email_send_seconds',
+    'Time spent sending an email over SMTP, including connecting if needed.')
 
 if sys.hexversion < 0x020603f0:
     # versions earlier than 2.6.3 have a bug in smtplib when sending over SSL:
     #     http://bugs.python.org/issue4066
     # Unfortunately the stock version of Python in Snow Leopard is 2.6.1, so
     # we patch it here to avoid having to install an updated Python version.
-    import socket
     import ssl
     from os import stderr
 
@@ -30,7 +40,7 @@ if sys.hexversion < 0x020603f0:
 def sendemail(from_addr=None, to_addrs=None, subject='No Subject',
               text_data=None, html_data=None,
               server='smtp.mozilla.org', port=25,
-              username=None, password=None, use_ssl=False):
+              username=None, password=None, use_ssl=False, timeout=60):
     """Sends an email.
 
      from_addr is an email address; to_addrs is a list of email adresses.
@@ -41,21 +51,27 @@ def sendemail(from_addr=None, to_addrs=None, subject='No Subject',
      If you specify both, the email will be sent as a MIME multipart
      alternative, i.e., the recipient will see the HTML content if his
      viewer supports it; otherwise he'll see the text content.
+
+     timeout is the number of seconds after which blocking SMTP operations
+     fail.
      """
 
+    msg = _build_message(from_addr, to_addrs, subject, text_data, html_data)
+    with send_duration.time():
+        server = _connect(server, port, username, password, use_ssl, timeout)
+        try:
+            server.sendmail(from_addr, to_addrs, msg.as_string())
+            server.quit()
+        finally:
+            server.close()
+
+
+def _build_message(from_addr, to_addrs, subject, text_data, html_data):
     if not from_addr or not to_addrs:
         raise Exception("Both from_addr and to_addrs must be specified")
     if not text_data and not html_data:
         raise Exception("Must specify either text_data or html_data")
 
-    if use_ssl:
-        server = smtplib.SMTP_SSL(server, port)
-    else:
-        server = smtplib.SMTP(server, port)
-
-    if username and password:
-        server.login(username, password)
-
     if not html_data:
         msg = MIMEText(text_data)
     elif not text_data:
@@ -70,7 +86,147 @@ def sendemail(from_addr=None, to_addrs=None, subject='No Subject',
     msg['Subject'] = subject
     msg['From'] = from_addr
     msg['To'] = ', '.join(to_addrs)
+    return msg
+
+
+def _connect(server, port, username, password, use_ssl, timeout):
+    if use_ssl:
+        connection = smtplib.SMTP_SSL(timeout=timeout)
+    else:
+        connection = smtplib.SMTP(timeout=timeout)
+
+    try:
+        connection.connect(server, port)
+        if username and password:
+            connection.login(username, password)
+    except Exception:
+        connection.close()
+        raise
+    return connection
+
+
+class MailDispatcher(object):
+    """Sends emails from a background thread fed by a bounded queue.
+
+    A single authenticated SMTP connection is kept open and reused for
+    every message, several messages being sent over it each time the
+    thread wakes up.  The connection is re-established after failures and
+    closed after being idle for ``idle_timeout`` seconds.  Messages that
+    fail because of connection problems or temporary (4xx) SMTP errors are
+    retried with exponential backoff, up to ``max_retries`` times.  SMTP
+    operations blocking for more than ``timeout`` seconds fail like
+    connection problems.
+    """
+
+    def __init__(self, server='smtp.mozilla.org', port=25, username=None,
+                 password=None, use_ssl=False, queue_size=100,
+                 batch_size=20, max_retries=5, retry_delay=1,
+                 idle_timeout=60, timeout=60):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self._messages = FifoQueue(queue_size)
+        self._connection = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='mail-dispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, from_addr=None, to_addrs=None, subject='No Subject',
+             text_data=None, html_data=None):
+        """Queues an email; see ``sendemail`` for the arguments.  Blocks
+        while the queue is full."""
+        msg = _build_message(from_addr, to_addrs, subject, text_data,
+                             html_data)
+        self._messages.put((from_addr, to_addrs, msg.as_string()))
+
+    def join(self):
+        """Waits for all queued emails to be sent or given up on."""
+        self._messages.join()
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._messages.get(timeout=self.idle_timeout)]
+            except Empty:
+                self._disconnect()
+                continue
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._messages.get_nowait())
+                except Empty:
+                    break
+
+            for message in batch:
+                try:
+                    self._deliver(*message)
+                except Exception:
+                    # An unexpected error must not stop the thread, or
+                    # ``send`` would eventually block forever.
+                    self._disconnect()
+                    mozdef.log(
+                        mozdef.ERROR,
+                        mozdef.OTHER,
+                        'Failed to send email.',
+                        details={
+                            'recipients': ', '.join(message[1]),
+                            'message': traceback.format_exc(),
+                        },
+                    )
+                finally:
+                    self._messages.task_done()
+
+    def _deliver(self, from_addr, to_addrs, msg):
+        for attempt in xrange(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                with send_duration.time():
+                    if self._connection is None:
+                        self._connection = _connect(
+                            self.server, self.port, self.username,
+                            self.password, self.use_ssl, self.timeout)
+                    self._connection.sendmail(from_addr, to_addrs, msg)
+                return
+            except (smtplib.SMTPServerDisconnected,
+                    smtplib.SMTPConnectError, socket.error) as e:
+                error = e
+                self._disconnect()
+            except smtplib.SMTPResponseException as e:
+                error = e
+                if not 400 <= e.smtp_code < 500:
+                    break
+            except smtplib.SMTPException as e:
+                # e.g. all recipients refused; retrying won't help.
+                error = e
+                break
 
-    server.sendmail(from_addr, to_addrs, msg.as_string())
+        mozdef.log(
+            mozdef.ERROR,
+            mozdef.OTHER,
+            'Failed to send email.',
+            details={
+                'recipients': ', '.join(to_addrs),
+                'message': str(error),
+            },
+        )
 
-    server.quit()
+    def _disconnect(self):
+        if self._connection is None:
+            return
+        try:
+            self._connection.quit()
+        except (smtplib.SMTPException, socket.error):
+            self._connection.close()
+        self._connection = None
@@ -0,0 +1,211 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Splitting of the queues between several guardian processes.
+
+Every worker records a heartbeat in the ``guardian_workers`` table from a
+background thread, independently of how long its guard cycles take, and
+reads the other workers' at the start of each cycle.  The workers with a
+recent heartbeat form a consistent hash ring over which queues are split
+by owner, so that when a worker joins or leaves only its share of the
+queues moves.  One of the workers, holding a Postgres advisory lock, is
+the leader and takes care of the cluster-wide chores.
+"""
+
+import bisect
+import hashlib
+import os
+import re
+import socket
+import threading
+import traceback
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from pulseguardian import mozdef
+from pulseguardian.model.base import db_session, engine
+from pulseguardian.model.guardian_worker import GuardianWorker
+
+# Key of the advisory lock held by the leader.
+LEADER_LOCK_KEY = 0x70756c7365
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """Consistent hash ring mapping keys to members.
+
+    :param replicas: Number of points of each member on the ring; more
+                     points spread keys more evenly.
+    """
+
+    def __init__(self, members, replicas=100):
+        self.members = sorted(members)
+        points = sorted((_hash(u'{0}:{1}'.format(member, i)), member)
+                        for member in self.members for i in xrange(replicas))
+        self._hashes = [h for h, member in points]
+        self._members = [member for h, member in points]
+
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._members[i]
+
+
+def shard_key(queue_name):
+    """Queues are split by owner so that all the queues of a Pulse user are
+    handled by the same worker; other queues are split by name."""
+    m = re.match('queue/([^/]+)/', queue_name)
+    return m.group(1) if m else queue_name
+
+
+class ShardCoordinator(object):
+    """Membership and leadership of one guardian worker.
+
+    :param timeout: Seconds without a heartbeat after which a worker is
+                    considered dead.  Once ``start`` is called, heartbeats
+                    are recorded three times per timeout.
+    """
+
+    def __init__(self, timeout, worker_id=None):
+        self.timeout = timeout
+        self.worker_id = worker_id or '{0}-{1}-{2}'.format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.ring = HashRing([self.worker_id])
+        self._started = datetime.utcnow()
+        self._stopped = threading.Event()
+        self._beater = None
+        self._lock_connection = None
+        self._advisory_locks = engine.dialect.name == 'postgresql'
+
+    def start(self):
+        """Record heartbeats from a background thread until ``leave`` is
+        called, so that a long guard cycle doesn't get this worker
+        declared dead."""
+        self._beater = threading.Thread(target=self._beat,
+                                        name='shard-heartbeat')
+        self._beater.daemon = True
+        self._beater.start()
+
+    def _beat(self):
+        # The thread gets its own session from the scoped session.
+        while not self._stopped.wait(self.timeout / 3.0):
+            try:
+                self._record_heartbeat()
+            except Exception:
+                db_session.rollback()
+                mozdef.log(
+                    mozdef.ERROR,
+                    mozdef.OTHER,
+                    'Recording heartbeat failed.',
+                    details={
+                        'worker': self.worker_id,
+                        'message': traceback.format_exc(),
+                    },
+                )
+        db_session.remove()
+
+    def _record_heartbeat(self):
+        now = datetime.utcnow()
+        db_session.merge(GuardianWorker(id=self.worker_id,
+                                        started=self._started,
+                                        heartbeat=now))
+        db_session.commit()
+        return now
+
+    def heartbeat(self):
+        """Record this worker's heartbeat, forget dead workers and update
+        the hash ring.  Returns True if the ring changed."""
+        now = self._record_heartbeat()
+        cutoff = now - timedelta(seconds=self.timeout)
+        GuardianWorker.query.filter(GuardianWorker.heartbeat < cutoff) \
+            .delete(synchronize_session=False)
+        db_session.commit()
+
+        members = [worker.id for worker in GuardianWorker.query]
+        if sorted(members) == self.ring.members:
+            return False
+
+        mozdef.log(
+            mozdef.NOTICE,
+            mozdef.OTHER,
+            'Shard map changed.',
+            details={
+                'worker': self.worker_id,
+                'workers': ', '.join(sorted(members)),
+            },
+        )
+        self.ring = HashRing(members)
+        return True
+
+    def owns(self, queue_name):
+        return self.owns_key(shard_key(queue_name))
+
+    def owns_key(self, key):
+        """Whether the queues with the given ``shard_key``, e.g. those of
+        a Pulse user, belong to this worker."""
+        return self.ring.owner(key) == self.worker_id
+
+    def is_leader(self):
+        """Whether this worker is the leader.
+
+        On Postgres, the leader is the worker holding an advisory lock,
+        which is released if it dies or loses its database connection.
+        Other databases fall back to the worker with the smallest id.
+        """
+        if not self._advisory_locks:
+            return self.ring.members[0] == self.worker_id
+
+        if self._lock_connection is not None:
+            try:
+                self._lock_connection.execute(text('SELECT 1'))
+                return True
+            except Exception:
+                # The lock went away with the connection.
+                self._lock_connection.invalidate()
+                self._lock_connection = None
+
+        # The lock is held by the session, not by a transaction; don't
+        # leave one open for as long as this worker leads.
+        connection = engine.connect().execution_options(autocommit=True)
+        acquired = connection.execute(
+            text('SELECT pg_try_advisory_lock(:key)'),
+            key=LEADER_LOCK_KEY).scalar()
+        if not acquired:
+            connection.close()
+            return False
+
+        self._lock_connection = connection
+        mozdef.log(
+            mozdef.NOTICE,
+            mozdef.OTHER,
+            'Became leader.',
+            details={'worker': self.worker_id},
+        )
+        return True
+
+    def leave(self):
+        """Remove this worker from the ring and give up leadership, e.g.
+        when shutting down."""
+        self._stopped.set()
+        if self._beater is not None:
+            self._beater.join()
+            self._beater = None
+
+        GuardianWorker.query.filter(
+            GuardianWorker.id == self.worker_id).delete()
+        db_session.commit()
+
+        if self._lock_connection is not None:
+            # The connection goes back to the pool, so the lock must be
+            # released explicitly.
+            self._lock_connection.execute(
+                text('SELECT pg_advisory_unlock(:key)'), key=LEADER_LOCK_KEY)
+            self._lock_connection.close()
+            self._lock_connection = None
@@ -13,7 +13,8 @@ $(document).ready(function() {
     var reloadInterval = 8000;
 
     function deleteableObjectHandler(collectionClass, objectType) {
-        $('.' + objectType + 's .delete').click(function() {
+        // Delegated, so that it also applies to objects added later.
+        $(document).on('click', '.' + objectType + 's .delete', function() {
             var objectInstance = $(this).closest('.' + objectType);
             var objectName = objectInstance.data(objectType + '-name');
             var modal = $('.modal-delete-' + objectType);
@@ -40,11 +41,80 @@ $(document).ready(function() {
         }
     });
 
+    function reloadListing() {
+        $('#queues-info').load('/queues_listing');
+    }
+
+    // Applies changes to the queue listing in place.  Returns false if a
+    // changed queue has nowhere to go, e.g. because its owner is new.
+    // Pulse users with several owners are listed, with their queues, under
+    // each of them.
+    function patchListing(listing, changes) {
+        var queues = {};
+        listing.find('li.queue').each(function() {
+            var name = $(this).attr('data-queue-name');
+            queues[name] = (queues[name] || $()).add(this);
+        });
+        var lists = {};
+        listing.find('ul.queues').each(function() {
+            var owner = $(this).attr('data-queue-owner');
+            lists[owner] = (lists[owner] || $()).add(this);
+        });
+
+        $.each(changes.deleted, function(i, name) {
+            if (queues[name]) {
+                queues[name].remove();
+            }
+        });
+
+        var patched = true;
+        $($.parseHTML(changes.html)).filter('li.queue').each(function() {
+            var queue = $(this);
+            var current = queues[queue.attr('data-queue-name')];
+            var owner = queue.attr('data-queue-owner');
+            if (!lists[owner]) {
+                patched = false;
+                return;
+            }
+            if (current && current.attr('data-queue-owner') === owner) {
+                current.each(function() {
+                    $(this).replaceWith(queue.clone());
+                });
+            } else {
+                if (current) {
+                    current.remove();
+                }
+                lists[owner].each(function() {
+                    $(this).append(queue.clone());
+                });
+            }
+        });
+        return patched;
+    }
+
+    // Fetches only what changed since the snapshot version the listing was
+    // rendered from, falling back to reloading the whole listing.
+    function updateListing() {
+        var listing = $('#queues-info .queue-listing');
+        var cursor = listing.attr('data-cursor');
+        if (!cursor) {
+            reloadListing();
+            return;
+        }
+
+        $.getJSON('/queues_listing/changes', {since: cursor})
+            .done(function(changes) {
+                if (changes.reset || !patchListing(listing, changes)) {
+                    reloadListing();
+                    return;
+                }
+                listing.attr('data-cursor', changes.cursor);
+            });
+    }
+
     setInterval(function() {
         if (autoReload) {
-            $('#queues-info').load('/queues_listing', function() {
-                deleteableObjectHandler('queues', 'queue');
-            });
+            updateListing();
         }
     }, reloadInterval);
 
@@ -31,9 +31,11 @@
 
 
 import base64
+import json
 import os.path
 import re
 import sys
+import time
 from functools import wraps
 
 import sqlalchemy.orm.exc
@@ -45,14 +47,18 @@ from flask import (abort,
                    redirect,
                    render_template,
                    request,
+                   Response,
                    session)
 from flask_secure_headers.core import Secure_Headers
 from flask_sslify import SSLify
-from sqlalchemy.orm import joinedload
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload, selectinload
 from werkzeug.routing import NotFound
 
-from pulseguardian import auth, config, management as pulse_management, mozdef
-from pulseguardian.model.base import db_session, init_db
+from pulseguardian import (auth, config, listing,
+                           management as pulse_management, metrics, mozdef)
+from pulseguardian.model.base import db_session, init_db, QueryCount
+from pulseguardian.model.binding import Binding
 from pulseguardian.model.pulse_user import PulseUser
 from pulseguardian.model.queue import Queue
 from pulseguardian.model.user import User
@@ -105,6 +111,11 @@ def generate_adhoc_ssl_pair(cn=None):
 # This is used by werkzeug.serving.make_ssl_devcert().
 werkzeug.serving.generate_adhoc_ssl_pair = generate_adhoc_ssl_pair
 
+request_duration = metrics.Histogram(
+    'pulseguardian_web_request_seconds',
+    'Duration of web requests.',
+    labels=('method', 'endpoint', 'status'))
+
 # Initialize the web app.
 app = Flask(__name__)
 app.config['SERVER_NAME'] = config.flask_server_name
@@ -204,11 +215,43 @@ def current_user(session):
     if not session.get('userinfo'):
         return None
 
-    return User.query.filter(
+    # Every page shows the user's Pulse users, and the profile their owners.
+    return User.query.options(
+        selectinload('pulse_users').selectinload('owners')
+    ).filter(
         User.email == session['userinfo']['email']
     ).first()
 
 
+def queue_snapshot():
+    """The guardian's latest queue listing snapshot, if it is in use."""
+    if not config.queue_snapshots:
+        return None
+    return listing.load(config.queue_snapshot_max_age)
+
+
+def listed_queues(snapshot=None):
+    """Return the users whose queues are listed and the queues without an
+    owner, from ``snapshot`` if given.
+
+    Otherwise, the listing templates walk every user's Pulse users, queues
+    and bindings, so they are all loaded up front in a fixed number of
+    queries rather than lazily, one query per object.
+    """
+    if snapshot is not None:
+        return snapshot.listing(g.user)
+
+    users = User.query.options(
+        selectinload('pulse_users').selectinload('queues')
+        .selectinload('bindings'))
+    if not g.user.admin:
+        return [users.filter(User.id == g.user.id).one()], []
+
+    no_owner_queues = Queue.query.options(selectinload('bindings')) \
+        .filter(Queue.owner == None)
+    return users.all(), no_owner_queues.all()
+
+
 @app.context_processor
 def inject_user():
     """Injects a user and configuration in templates' context."""
@@ -223,6 +266,22 @@ def inject_user():
                 session=session)
 
 
+@app.before_request
+def start_query_count():
+    # Registered first so that the queries of the other hooks are counted.
+    if config.query_counting:
+        g._query_count = QueryCount('web request').start()
+
+
+@app.teardown_request
+def log_query_count(exception=None):
+    query_count = getattr(g, '_query_count', None)
+    if query_count is not None:
+        query_count.stop()
+        query_count.log(details={'method': request.method,
+                                 'endpoint': request.endpoint or ''})
+
+
 @app.before_request
 def load_user():
     """Loads the currently logged-in user (if any) to the request context."""
@@ -273,6 +332,22 @@ def _csrf_protect():
             abort(400)
 
 
+@app.before_request
+def start_request_timer():
+    g._request_started = time.time()
+
+
+@app.after_request
+def observe_request_duration(response):
+    started = getattr(g, '_request_started', None)
+    if started is not None:
+        request_duration.observe(time.time() - started,
+                                 method=request.method,
+                                 endpoint=request.endpoint or '',
+                                 status=response.status_code)
+    return response
+
+
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     db_session.remove()
@@ -302,13 +377,7 @@ def register(error=None):
 @sh.wrapper()
 @oidc.oidc_auth
 def profile(error=None, messages=None):
-    users = no_owner_queues = []
-    if g.user.admin:
-        users = User.query.all()
-        no_owner_queues = list(Queue.query.filter(Queue.owner == None))
-    return render_template('profile.html', users=users,
-                           no_owner_queues=no_owner_queues,
-                           error=error, messages=messages)
+    return render_template('profile.html', error=error, messages=messages)
 
 
 @app.route('/all_users')
@@ -332,30 +401,62 @@ def all_pulse_users():
 @sh.wrapper()
 @oidc.oidc_auth
 def queues():
-    if g.user.admin:
-        users = User.query.all()
-        no_owner_queues = list(Queue.query.filter(Queue.owner == None))
-    else:
-        users = [current_user(session)]
-        no_owner_queues = []
-
+    snapshot = queue_snapshot()
+    users, no_owner_queues = listed_queues(snapshot)
     return render_template('queues.html', users=users,
-                           no_owner_queues=no_owner_queues)
+                           no_owner_queues=no_owner_queues,
+                           cursor=snapshot and snapshot.version)
 
 
 @app.route('/queues_listing')
 @sh.wrapper()
 @oidc.oidc_auth
 def queues_listing():
-    if g.user.admin:
-        users = User.query.all()
-        no_owner_queues = list(Queue.query.filter(Queue.owner == None))
+    snapshot = queue_snapshot()
+    if snapshot is None:
+        users, no_owner_queues = listed_queues()
+        return render_template('queues_listing.html', users=users,
+                               no_owner_queues=no_owner_queues)
+
+    # The listing embeds the session's CSRF token.
+    etag = snapshot.etag(g.user, generate_csrf_token())
+    if etag in request.if_none_match:
+        response = Response(status=304)
     else:
-        users = [current_user(session)]
-        no_owner_queues = []
-
-    return render_template('queues_listing.html', users=users,
-                           no_owner_queues=no_owner_queues)
+        users, no_owner_queues = listed_queues(snapshot)
+        response = Response(render_template('queues_listing.html',
+                                            users=users,
+                                            no_owner_queues=no_owner_queues,
+                                            cursor=snapshot.version))
+    response.set_etag(etag)
+    # Have browsers revalidate the listing every time it's reloaded.
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/queues_listing/changes')
+@sh.wrapper()
+@oidc.oidc_auth
+def queues_listing_changes():
+    """Queues changed since the snapshot version given as the ``since``
+    parameter, as the HTML of their listing items, and names of the queues
+    deleted since then.  ``cursor`` is the version to ask changes from
+    next time.  If ``reset`` is true, changes can't be followed from that
+    version and the whole listing must be reloaded instead."""
+    snapshot = queue_snapshot()
+    since = request.args.get('since', type=int)
+    changes = None
+    if snapshot is not None and since is not None:
+        changes = snapshot.changes(g.user, since)
+    if changes is None:
+        return jsonify(reset=True)
+
+    changed, deleted = changes
+    html = ''
+    if changed:
+        html = render_template('queues_changes.html', queues=changed)
+    return jsonify(reset=False, cursor=snapshot.version, html=html,
+                   deleted=deleted)
 
 
 # API
@@ -395,6 +496,9 @@ def delete_queue(queue_name):
         )
         db_session.delete(queue)
         db_session.commit()
+        if config.queue_snapshots:
+            # Don't keep listing it until the guardian's next cycle.
+            listing.mark_stale()
         return jsonify(ok=True)
 
     return jsonify(ok=False)
@@ -432,6 +536,9 @@ def delete_pulse_user(pulse_username):
         )
         db_session.delete(pulse_user)
         db_session.commit()
+        if config.queue_snapshots:
+            # Don't keep listing it until the guardian's next cycle.
+            listing.mark_stale()
         return jsonify(ok=True)
 
     return jsonify(ok=False)
@@ -486,16 +593,188 @@ def contribute_json():
     return app.send_static_file('contribute.json')
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_exposition():
+    return Response(metrics.exposition(), mimetype=metrics.CONTENT_TYPE)
+
+
+def _owned_queues(query):
+    """Restrict ``query``, which must select from the queues, to those of
+    the logged-in user's Pulse users, unless they are an admin."""
+    if g.user is not None and g.user.admin:
+        return query
+    pulse_users = g.user.pulse_users if g.user is not None else []
+    return query.filter(Queue.owner_id.in_(
+        [pulse_user.id for pulse_user in pulse_users]))
+
+
+def _queue_bindings(queue_names):
+    """Return the bindings of each of ``queue_names``, in the format of the
+    management API, as mirrored in the database by the guardian.  Only the
+    bindings of queues the user can see are returned.
+
+    They are read in a single query rather than asked to RabbitMQ, at the
+    cost of being up to a guard cycle old.
+    """
+    bindings = {name: [] for name in queue_names}
+    query = db_session.query(Binding.queue_name, Binding.exchange,
+                             Binding.routing_key) \
+        .join(Queue, Binding.queue_name == Queue.name) \
+        .filter(Binding.queue_name.in_(bindings.keys()))
+    rows = _owned_queues(query) \
+        .order_by(Binding.queue_name, Binding.exchange, Binding.routing_key)
+    for queue_name, exchange, routing_key in rows:
+        bindings[queue_name].append({
+            'source': exchange,
+            'vhost': '/',
+            'destination': queue_name,
+            'destination_type': 'queue',
+            'routing_key': routing_key,
+        })
+    return bindings
+
+
 @app.route('/queue/<path:queue_name>/bindings', methods=["GET"])
 @sh.wrapper()
+@oidc.oidc_auth
 def bindings_listing(queue_name):
-    queue = Queue.query.get(queue_name)
-    bindings = []
-    if queue:
-        bindings = pulse_management.queue_bindings(vhost='/', queue=queue.name)
+    bindings = _queue_bindings([queue_name])[queue_name]
     return jsonify({"queue_name": queue_name, "bindings": bindings})
 
 
+@app.route('/api/bindings', methods=['GET'])
+@sh.wrapper()
+@oidc.oidc_auth
+def api_bindings():
+    """Bindings of each of the queues given as ``queue`` parameters, by
+    queue name, like ``bindings_listing`` does for a single queue."""
+    queue_names = request.args.getlist('queue')
+    if len(queue_names) > config.api_queues_max_page_size:
+        abort(400)
+    return jsonify(bindings=_queue_bindings(queue_names))
+
+
+def _bool_arg(name):
+    """Value of the boolean request parameter ``name``, None if absent."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if value.lower() in ('1', 'true'):
+        return True
+    if value.lower() in ('0', 'false'):
+        return False
+    abort(400)
+
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key))
+
+
+def _decode_cursor(cursor, length):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, ValueError, UnicodeError):
+        abort(400)
+    if not isinstance(key, list) or len(key) != length:
+        abort(400)
+    return key
+
+
+@app.route('/api/queues', methods=['GET'])
+@sh.wrapper()
+@oidc.oidc_auth
+def api_queues():
+    """Queues matching the request parameters, one page at a time.
+    Users other than admins only get the queues of their Pulse users.
+
+    Queues can be filtered by ``owner`` (a Pulse username), ``min_size``,
+    ``max_size``, ``prefix`` of their name and the ``warned``, ``durable``
+    and ``unbounded`` flags, and sorted by ``name`` (the default), ``size``
+    or ``-size``.  At most ``limit`` queues are returned, along with a
+    ``next`` cursor to pass as the ``after`` parameter to get the following
+    page, which is null on the last one.
+
+    Pages are read from the indexed sort columns starting after the last
+    queue of the previous page, rather than skipping the queues before it,
+    so every page is as cheap as the first one.
+    """
+    limit = request.args.get('limit', config.api_queues_page_size, type=int)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, config.api_queues_max_page_size)
+
+    sort = request.args.get('sort', 'name')
+    if sort == 'name':
+        keys = [Queue.name]
+    elif sort in ('size', '-size'):
+        keys = [Queue.size, Queue.name]
+    else:
+        abort(400)
+    descending = sort.startswith('-')
+
+    query = db_session.query(Queue.name, PulseUser.username, Queue.size,
+                             Queue.warned, Queue.durable, Queue.unbounded) \
+        .outerjoin(PulseUser, Queue.owner_id == PulseUser.id)
+    query = _owned_queues(query)
+
+    owner = request.args.get('owner')
+    if owner is not None:
+        query = query.filter(PulseUser.username == owner)
+    prefix = request.args.get('prefix')
+    if prefix:
+        query = query.filter(Queue.name.startswith(prefix, autoescape=True))
+    min_size = request.args.get('min_size', type=int)
+    if min_size is not None:
+        query = query.filter(Queue.size >= min_size)
+    max_size = request.args.get('max_size', type=int)
+    if max_size is not None:
+        query = query.filter(Queue.size <= max_size)
+    if Queue.size in keys:
+        # Queues are only sized once the guardian has seen them.
+        query = query.filter(Queue.size != None)
+    for flag in ('warned', 'durable', 'unbounded'):
+        value = _bool_arg(flag)
+        if value is not None:
+            column = getattr(Queue, flag)
+            # Flags that were never set count as false.
+            query = query.filter(column == True if value else
+                                 or_(column == False, column == None))
+
+    after = request.args.get('after')
+    if after:
+        values = _decode_cursor(after, len(keys))
+        # (key1, key2) > (value1, value2), spelled out for SQLite.
+        condition = None
+        for key, value in reversed(zip(keys, values)):
+            beyond = key < value if descending else key > value
+            if condition is None:
+                condition = beyond
+            else:
+                condition = or_(beyond, and_(key == value, condition))
+        query = query.filter(condition)
+
+    query = query.order_by(*[key.desc() if descending else key
+                             for key in keys])
+    rows = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = _encode_cursor([last.size, last.name]
+                                     if len(keys) == 2 else [last.name])
+
+    queues = [{
+        'name': name,
+        'owner': username,
+        'size': size,
+        'warned': bool(warned),
+        'durable': bool(durable),
+        'unbounded': bool(unbounded),
+    } for name, username, size, warned, durable, unbounded in rows]
+    return jsonify(queues=queues, next=next_cursor)
+
+
 @app.route("/update_info", methods=['POST'])
 @sh.wrapper()
 @oidc.oidc_auth
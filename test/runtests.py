@@ -4,14 +4,18 @@
 
 import base64
 import errno
+import json
 import logging
 import multiprocessing
 import os
+import smtplib
 import socket
 import sys
 import time
 import unittest
 import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from urlparse import urlparse
 
 from kombu import Exchange
@@ -27,13 +31,20 @@ config.fake_account = 'guardtest@guardtest.com'
 
 from docker_setup import (check_rabbitmq, create_image,
                           setup_container, teardown_container)
-from pulseguardian import dbinit, management as pulse_management, web
-from pulseguardian.guardian import PulseGuardian
-from pulseguardian.model.base import db_session
+from pulseguardian import (dbinit, digest, listing,
+                           management as pulse_management, metrics, web)
+from pulseguardian.cache import TTLCache
+from pulseguardian.growth import GrowthTracker, PollScheduler
+from pulseguardian.guardian import DatabaseSnapshot, PulseGuardian
+from pulseguardian.model.base import db_session, QueryCount
 from pulseguardian.model.binding import Binding
+from pulseguardian.model.guardian_worker import GuardianWorker
 from pulseguardian.model.pulse_user import PulseUser
 from pulseguardian.model.queue import Queue
+from pulseguardian.model.queue_snapshot import QueueSnapshot
 from pulseguardian.model.user import User
+from pulseguardian.sendemail import MailDispatcher, sendemail
+from pulseguardian.sharding import HashRing, ShardCoordinator, shard_key
 
 web.app.config['TESTING'] = True
 
@@ -429,6 +440,43 @@ class GuardianTest(unittest.TestCase):
                                self.guardian.del_queue_size]
         self.assertEqual(len(queues_to_delete), 0)
 
+    def test_delete_after_failed_pass(self):
+        self._setup_queue()
+        self._wait_for_queue()
+
+        for i in xrange(self.guardian.del_queue_size + 1):
+            self.publisher.publish(self._build_message(i))
+
+        for i in xrange(100):
+            time.sleep(0.3)
+            queues_to_delete = [q_data['name'] for q_data
+                                in pulse_management.queues()
+                                if q_data['messages_ready']
+                                   > self.guardian.del_queue_size]
+            if queues_to_delete:
+                break
+        self.assertGreater(len(queues_to_delete), 0)
+
+        # The fetch fails after the overgrown queues were seen.
+        def queues():
+            for queue_data in pulse_management.queues():
+                yield queue_data
+            raise IOError('Connection reset.')
+
+        with self.assertRaises(IOError):
+            self.guardian.monitor_queues(queues(),
+                                         pulse_management.bindings())
+        db_session.rollback()
+        self.assertEqual(self.guardian._deletions, {})
+        # Nothing was committed, so no fingerprint was recorded.
+        self.assertEqual(self.guardian._fingerprints, {})
+
+        # The queues aren't skipped as pending deletion by the next pass.
+        self.guardian.monitor_queues(pulse_management.queues(),
+                                     pulse_management.bindings())
+        self.assertFalse(any(q_data['name'] in queues_to_delete
+                             for q_data in pulse_management.queues()))
+
     def test_delete_skip_unbounded(self):
         self._setup_queue()
 
@@ -483,6 +531,22 @@ class GuardianTest(unittest.TestCase):
         # And that they were not deleted by guardian...
         self.assertGreater(len(queues_to_delete), 0)
 
+    def test_clear_deleted_queues(self):
+        """Test that records of queues missing from a listing are only
+        cleared if the queues are really gone"""
+        self._setup_queue()
+        queue = Queue.query.one()
+        queue.unbounded = True
+        db_session.add(Queue(name='queue/{0}/gone'.format(CONSUMER_USER)))
+        db_session.commit()
+
+        # Neither queue is listed, e.g. because the listing shifted while
+        # it was paged through.
+        self.guardian.clear_deleted_queues([], [])
+
+        self.assertEqual([q.name for q in Queue.query.all()], [queue.name])
+        self.assertTrue(Queue.query.one().unbounded)
+
     def test_binding(self):
         """Test that you can get the bindings for a queue"""
         self._setup_queue()
@@ -556,7 +620,162 @@ class GuardianTest(unittest.TestCase):
         test_bindings({"#"})
 
 
-class ModelTest(unittest.TestCase):
+class QueryCountAssertions(object):
+
+    """Mixin for test cases bounding the number of SQL statements run."""
+
+    @contextmanager
+    def assertMaxQueries(self, maximum):
+        with QueryCount() as query_count:
+            yield query_count
+        if query_count.total > maximum:
+            self.fail('{0} queries run, expected at most {1}:\n{2}'.format(
+                query_count.total, maximum, '\n'.join(
+                    '{0}x {1}'.format(count, statement)
+                    for statement, count in query_count.repeated(1))))
+
+
+class JsonArrayTest(unittest.TestCase):
+
+    """Tests the incremental decoding of management API listings."""
+
+    def decode(self, chunks):
+        return list(pulse_management._iter_json_array(iter(chunks)))
+
+    def assertDecodes(self, text):
+        expected = json.loads(text)
+        # The opening bracket is read by the caller.
+        body = text[text.index(u'[') + 1:]
+        for i in xrange(len(body) + 1):
+            for j in xrange(i, len(body) + 1):
+                self.assertEqual(
+                    self.decode([body[:i], body[i:j], body[j:]]), expected,
+                    'Chunks: {0!r}'.format([body[:i], body[i:j], body[j:]]))
+        self.assertEqual(self.decode(list(body)), expected)
+
+    def test_numbers(self):
+        self.assertDecodes(u'[1.5, -3.0, 1e3, 12, -0.25E-2, 0]')
+
+    def test_values(self):
+        self.assertDecodes(u'[ "a,b]", "\\u00e9\\"", true, false, null ]')
+        self.assertDecodes(u'[[1, [2]], {"a": [1.5], "b": {"c": "]"}}]')
+        self.assertDecodes(u'[]')
+
+    def test_queues(self):
+        self.assertDecodes(json.dumps([
+            {'name': 'queue/user/{0}'.format(i), 'vhost': '/',
+             'messages': i * 1001, 'messages_ready': i, 'durable': i % 2}
+            for i in xrange(3)]).decode('utf-8'))
+
+    def test_truncated(self):
+        for chunks in ([u'1, 2'], [u'1.', u'5'], [u'{"a": 1}, {']):
+            with self.assertRaises(ValueError):
+                self.decode(chunks)
+
+
+class StubSMTP(object):
+
+    """Stands in for ``smtplib.SMTP``, recording the recipients of the
+    messages sent over each connection and raising the errors queued in
+    ``failures`` instead of sending the next messages."""
+
+    connections = []
+    failures = []
+
+    def __init__(self, host='', port=0, timeout=None):
+        self.timeout = timeout
+        self.sent = []
+        self.closed = False
+        StubSMTP.connections.append(self)
+
+    def connect(self, host, port):
+        pass
+
+    def login(self, username, password):
+        if password != 'secret':
+            raise smtplib.SMTPAuthenticationError(535, 'Bad credentials')
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if StubSMTP.failures:
+            raise StubSMTP.failures.pop(0)
+        self.sent.extend(to_addrs)
+
+    def quit(self):
+        self.close()
+
+    def close(self):
+        self.closed = True
+
+
+class MailDispatcherTest(unittest.TestCase):
+
+    """Tests the sending of emails over reused SMTP connections."""
+
+    def setUp(self):
+        self._smtp = smtplib.SMTP
+        smtplib.SMTP = StubSMTP
+        StubSMTP.connections = []
+        StubSMTP.failures = []
+
+    def tearDown(self):
+        smtplib.SMTP = self._smtp
+
+    def dispatch(self, recipients, **kwargs):
+        dispatcher = MailDispatcher(username='guardian', password='secret',
+                                    retry_delay=0, **kwargs)
+        # Queued before the thread starts, so sent in a single batch.
+        for recipient in recipients:
+            dispatcher.send(from_addr='guardian@example.com',
+                            to_addrs=[recipient], text_data='Hello')
+        dispatcher.start()
+        dispatcher.join()
+        return [connection.sent for connection in StubSMTP.connections]
+
+    def test_batching(self):
+        self.assertEqual(self.dispatch(['a', 'b', 'c'], timeout=5),
+                         [['a', 'b', 'c']])
+        self.assertEqual(StubSMTP.connections[0].timeout, 5)
+        self.assertFalse(StubSMTP.connections[0].closed)
+
+    def test_retries(self):
+        StubSMTP.failures = [smtplib.SMTPServerDisconnected(),
+                             smtplib.SMTPResponseException(451, 'Later')]
+        # Reconnects after being disconnected, and retries temporary
+        # errors on the same connection.
+        self.assertEqual(self.dispatch(['a', 'b']), [[], ['a', 'b']])
+        self.assertTrue(StubSMTP.connections[0].closed)
+
+    def test_failures(self):
+        StubSMTP.failures = [smtplib.SMTPResponseException(550, 'Nope'),
+                             socket.timeout(), socket.timeout(),
+                             socket.timeout()]
+        # Permanent errors aren't retried.  Timeouts drop the connection;
+        # other messages are still sent once a message exhausted its
+        # retries.
+        self.assertEqual(self.dispatch(['a', 'b', 'c'], max_retries=2),
+                         [[], [], [], ['c']])
+
+    def test_unexpected_error(self):
+        StubSMTP.failures = [UnicodeEncodeError('ascii', u'\xe9', 0, 1,
+                                                'ordinal not in range')]
+        # The message is given up on, but the thread keeps sending.
+        self.assertEqual(self.dispatch(['a', 'b']), [[], ['b']])
+        self.assertTrue(StubSMTP.connections[0].closed)
+
+    def test_failed_login(self):
+        with self.assertRaises(smtplib.SMTPAuthenticationError):
+            sendemail(from_addr='guardian@example.com', to_addrs=['a'],
+                      text_data='Hello', username='guardian',
+                      password='wrong')
+        self.assertTrue(StubSMTP.connections[0].closed)
+
+        sendemail(from_addr='guardian@example.com', to_addrs=['a'],
+                  text_data='Hello', username='guardian', password='secret')
+        self.assertEqual(StubSMTP.connections[1].sent, ['a'])
+        self.assertTrue(StubSMTP.connections[1].closed)
+
+
+class ModelTest(QueryCountAssertions, unittest.TestCase):
 
     """Tests the underlying model (users and queues)."""
 
@@ -599,8 +818,405 @@ class ModelTest(unittest.TestCase):
 
         self.assertTrue(userDb.admin)
 
+    def test_query_count(self):
+        User.new_user(email='counted@email.com', admin=False)
+
+        with self.assertMaxQueries(3) as query_count:
+            for i in range(3):
+                User.query.filter(User.email == 'counted@email.com').first()
+        self.assertEqual(query_count.total, 3)
+        [(statement, count)] = query_count.repeated(3)
+        self.assertIn('FROM users', statement)
+        self.assertEqual(count, 3)
+
+        with self.assertRaises(AssertionError):
+            with self.assertMaxQueries(1):
+                User.query.all()
+                User.query.all()
+
+    def test_bindings_insert_delete_many(self):
+        db_session.add(Queue(name='queue/bulk/0',
+                             bindings=[Binding(exchange='exchange/test',
+                                               routing_key='old')]))
+        db_session.commit()
+
+        with self.assertMaxQueries(1):
+            Binding.insert_many([('queue/bulk/0', 'exchange/test', str(i))
+                                 for i in range(3)])
+        db_session.commit()
+        bindings = Binding.query.filter(Binding.queue_name == 'queue/bulk/0')
+        self.assertEqual(sorted(b.routing_key for b in bindings),
+                         ['0', '1', '2', 'old'])
+
+        # Existing bindings are skipped.
+        Binding.insert_many([('queue/bulk/0', 'exchange/test', 'old'),
+                             ('queue/bulk/0', 'exchange/test', '3')])
+        db_session.commit()
+        self.assertEqual(sorted(b.routing_key for b in bindings),
+                         ['0', '1', '2', '3', 'old'])
 
-class WebTest(unittest.TestCase):
+        new_ids = [b.id for b in bindings if b.routing_key != 'old']
+        with self.assertMaxQueries(1):
+            Binding.delete_many(new_ids)
+        db_session.commit()
+        self.assertEqual([b.routing_key for b in bindings], ['old'])
+
+    def test_queues_delete_many(self):
+        for i in range(3):
+            db_session.add(Queue(name='queue/bulk/{0}'.format(i),
+                                 bindings=[Binding(exchange='exchange/test',
+                                                   routing_key=str(i))]))
+        db_session.commit()
+
+        # The queues and their bindings are deleted without being loaded.
+        with self.assertMaxQueries(2):
+            Queue.delete_many(['queue/bulk/0', 'queue/bulk/1'])
+        db_session.commit()
+        self.assertEqual([q.name for q in Queue.query.all()],
+                         ['queue/bulk/2'])
+        self.assertEqual([b.routing_key for b in Binding.query.all()], ['2'])
+
+
+class GrowthTest(unittest.TestCase):
+
+    """Tests the projection of queue growth."""
+
+    def setUp(self):
+        self.tracker = GrowthTracker(max_samples=5, window=60)
+
+    def observe(self, name, samples):
+        for at, size in samples:
+            self.tracker.observe(name, '/', size, at)
+
+    def test_rate(self):
+        self.observe('growing', [(0, 100), (5, 150), (10, 200)])
+        self.observe('draining', [(0, 100), (5, 50)])
+        self.observe('new', [(0, 100)])
+
+        self.assertAlmostEqual(self.tracker.rate('growing'), 10)
+        self.assertAlmostEqual(self.tracker.rate('draining'), -10)
+        self.assertEqual(self.tracker.rate('new'), 0)
+        self.assertEqual(self.tracker.rate('unknown'), 0)
+
+    def test_rate_ignores_old_samples(self):
+        # The queue was drained a while ago and grows steadily since.
+        self.observe('queue', [(0, 1000), (10, 0), (100, 100), (110, 200)])
+        self.assertAlmostEqual(self.tracker.rate('queue'), 10)
+
+    def test_time_to(self):
+        self.observe('growing', [(0, 100), (10, 200)])
+        self.observe('draining', [(0, 100), (10, 50)])
+
+        self.assertAlmostEqual(self.tracker.time_to('growing', 500), 30)
+        self.assertEqual(self.tracker.time_to('growing', 150), 0)
+        self.assertIsNone(self.tracker.time_to('draining', 500))
+        self.assertIsNone(self.tracker.time_to('unknown', 500))
+
+    def test_hot_queues(self):
+        scheduler = PollScheduler(self.tracker, (1000, 5000), interval=5,
+                                  max_interval=40)
+        # Crosses the warning size in about 2.5 seconds.
+        self.observe('hot', [(0, 700), (5, 900)])
+        # Crosses the deletion size in about 11 seconds.
+        self.observe('warm', [(0, 1800), (5, 2800)])
+        # Not growing.
+        self.observe('cold', [(0, 900), (5, 900)])
+
+        self.assertEqual(scheduler.hot_queues(), [('/', 'hot')])
+        self.assertEqual(sorted(scheduler.hot_queues(horizon=30)),
+                         [('/', 'hot'), ('/', 'warm')])
+
+    def test_sweep_interval(self):
+        scheduler = PollScheduler(self.tracker, (1000, 5000), interval=5,
+                                  max_interval=40)
+        self.observe('queue', [(0, 100), (5, 100)])
+        self.assertEqual([scheduler.update() for i in xrange(4)],
+                         [10, 20, 40, 40])
+
+        # Crosses the warning size within the maximum interval.
+        self.observe('queue', [(10, 500)])
+        self.assertEqual(scheduler.update(), 5)
+
+    def test_predictive_thresholds(self):
+        guardian = PulseGuardian(warn_queue_size=TEST_WARN_SIZE,
+                                 del_queue_size=TEST_DELETE_SIZE,
+                                 emails=False)
+        step = TEST_WARN_SIZE / 4
+        for i in xrange(4):
+            guardian._growth.observe('queue', '/', i * step, i)
+
+        # Exceeds the warning size in 1.2 seconds.
+        self.assertTrue(guardian._projected_to_exceed(
+            'queue', TEST_WARN_SIZE, 2))
+        self.assertFalse(guardian._projected_to_exceed(
+            'queue', TEST_WARN_SIZE, 1))
+        self.assertFalse(guardian._projected_to_exceed(
+            'unknown', TEST_WARN_SIZE, 1))
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    """Tests the cache of the exchanges of unbound queues."""
+
+    def test_expiry(self):
+        cache = TTLCache(0.5)
+        cache.set('queue', 'exchange')
+        self.assertEqual(cache.get('queue'), 'exchange')
+        self.assertIsNone(cache.get('other'))
+
+        time.sleep(0.6)
+        self.assertEqual(cache.get('queue', 'expired'), 'expired')
+        # Expired entries are dropped when looked up.
+        self.assertEqual(len(cache), 0)
+
+        # Setting an entry again renews it.
+        cache.set('queue', 'exchange')
+        time.sleep(0.3)
+        cache.set('queue', 'other exchange')
+        time.sleep(0.3)
+        self.assertEqual(cache.get('queue'), 'other exchange')
+
+    def test_max_size(self):
+        cache = TTLCache(60, max_size=2)
+        for key in ('a', 'b', 'c'):
+            cache.set(key, key.upper())
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), 'C')
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class DigestTest(unittest.TestCase):
+
+    """Tests the coalescing of queue notifications into digests."""
+
+    def setUp(self):
+        self.digest = digest.NotificationDigest(10, min_interval=60)
+
+    def test_grouping(self):
+        self.digest.add(['a', 'b'], 'q1', digest.WARNING, 'q1 warned', 0)
+        self.digest.add(['a'], 'q2', digest.DELETED, 'q2 deleted', 5)
+        self.digest.add(['a'], 'q3', digest.WARNING, 'q3 warned', 5)
+
+        self.assertEqual(self.digest.pop_due(9), [])
+        self.assertEqual(sorted(self.digest.pop_due(10)), [
+            ('a', {digest.DELETED: ['q2 deleted'],
+                   digest.WARNING: ['q1 warned', 'q3 warned']}),
+            ('b', {digest.WARNING: ['q1 warned']}),
+        ])
+        # Flushed digests aren't sent again.
+        self.assertEqual(self.digest.pop_due(100), [])
+
+    def test_coalescing(self):
+        self.digest.add(['a'], 'q1', digest.WARNING, 'q1 warned', 0)
+        self.digest.add(['a'], 'q1', digest.BACK_TO_NORMAL, 'q1 normal', 1)
+        self.digest.add(['a'], 'q2', digest.WARNING, 'q2 warned', 1)
+        self.digest.add(['a'], 'q2', digest.DELETED, 'q2 deleted', 2)
+        # A new queue with the name of a deleted one.
+        self.digest.add(['a'], 'q2', digest.WARNING, 'q2 warned again', 3)
+
+        self.assertEqual(self.digest.pop_due(10), [
+            ('a', {digest.BACK_TO_NORMAL: ['q1 normal'],
+                   digest.DELETED: ['q2 deleted'],
+                   digest.WARNING: ['q2 warned again']}),
+        ])
+
+    def test_min_interval(self):
+        self.digest.add(['a'], 'q1', digest.WARNING, 'q1 warned', 0)
+        self.assertEqual(len(self.digest.pop_due(10)), 1)
+
+        # The window has passed, but the last digest was sent too recently.
+        self.digest.add(['a'], 'q2', digest.WARNING, 'q2 warned', 11)
+        self.assertEqual(self.digest.pop_due(21), [])
+        self.assertEqual(self.digest.pop_due(70),
+                         [('a', {digest.WARNING: ['q2 warned']})])
+
+
+class MetricsTest(unittest.TestCase):
+
+    """Tests the exposition of metrics in the Prometheus text format."""
+
+    def tearDown(self):
+        for name in ('test_requests_total', 'test_request_seconds'):
+            metrics.registry.pop(name, None)
+
+    def test_counter(self):
+        counter = metrics.Counter('test_requests_total', 'Requests.',
+                                  labels=('path',))
+        counter.inc(path='/a"b\\c\nd')
+        counter.inc(2, path='/')
+        self.assertEqual(counter.exposition(), [
+            '# HELP test_requests_total Requests.',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{path="/"} 2.0',
+            'test_requests_total{path="/a\\"b\\\\c\\nd"} 1.0',
+        ])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_request_seconds', 'Durations.',
+                                      labels=('method',), buckets=(1, 0.1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, method='GET')
+        histogram.observe(0.1, method='PUT')
+
+        lines = histogram.exposition()
+        self.assertEqual(lines[2:7], [
+            'test_request_seconds_bucket{method="GET",le="0.1"} 1.0',
+            'test_request_seconds_bucket{method="GET",le="1.0"} 2.0',
+            'test_request_seconds_bucket{method="GET",le="+Inf"} 3.0',
+            'test_request_seconds_sum{method="GET"} 5.55',
+            'test_request_seconds_count{method="GET"} 3.0',
+        ])
+        # Bounds are inclusive.
+        self.assertIn(
+            'test_request_seconds_bucket{method="PUT",le="0.1"} 1.0', lines)
+
+        with histogram.time(method='PUT'):
+            pass
+        self.assertEqual(histogram.values()[('PUT',)][2], 2)
+
+    def test_exposition(self):
+        metrics.Counter('test_requests_total', 'Requests.').inc()
+        text = metrics.exposition()
+        self.assertTrue(text.endswith('\n'))
+        self.assertIn('# TYPE test_requests_total counter\n'
+                      'test_requests_total 1.0\n', text)
+        # Metrics of the guardian's modules are registered on import.
+        self.assertIn('# TYPE pulseguardian_web_request_seconds histogram',
+                      text)
+
+
+class ShardingTest(QueryCountAssertions, unittest.TestCase):
+
+    """Tests the splitting of queues between guardian workers."""
+
+    def setUp(self):
+        dbinit.init_and_clear_db()
+
+    def test_shard_key(self):
+        self.assertEqual(shard_key('queue/alice/jobs'), 'alice')
+        self.assertEqual(shard_key('queue/alice/other'), 'alice')
+        self.assertEqual(shard_key('abnormal.queue'), 'abnormal.queue')
+
+    def test_ring_stability(self):
+        keys = ['user{0}'.format(i) for i in xrange(1000)]
+        ring = HashRing(['a', 'b', 'c'])
+        owners = {key: ring.owner(key) for key in keys}
+        self.assertEqual(set(owners.values()), {'a', 'b', 'c'})
+
+        # Only the keys of a worker that leaves move.
+        ring = HashRing(['a', 'c'])
+        for key in keys:
+            if owners[key] != 'b':
+                self.assertEqual(ring.owner(key), owners[key])
+
+        # Only the keys taken over by a worker that joins move.
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys if ring.owner(key) != owners[key]]
+        self.assertGreater(len(moved), 0)
+        self.assertLess(len(moved), len(keys) / 2)
+        self.assertTrue(all(ring.owner(key) == 'd' for key in moved))
+
+        self.assertIsNone(HashRing([]).owner('alice'))
+
+    def test_leader_failover(self):
+        a = ShardCoordinator(60, worker_id='a')
+        b = ShardCoordinator(60, worker_id='b')
+        a.heartbeat()
+        b.heartbeat()
+        self.assertTrue(a.heartbeat())
+        self.assertEqual(a.ring.members, ['a', 'b'])
+        self.assertTrue(a.is_leader())
+        self.assertFalse(b.is_leader())
+        keys = ['user{0}'.format(i) for i in xrange(100)]
+        self.assertTrue(all(a.owns_key(key) != b.owns_key(key)
+                            for key in keys))
+
+        a.leave()
+        self.assertTrue(b.heartbeat())
+        self.assertEqual(b.ring.members, ['b'])
+        self.assertTrue(b.is_leader())
+        self.assertTrue(all(b.owns_key(key) for key in keys))
+
+    def test_dead_worker(self):
+        a = ShardCoordinator(60, worker_id='a')
+        b = ShardCoordinator(60, worker_id='b')
+        a.heartbeat()
+        b.heartbeat()
+
+        # The leader stops sending heartbeats.
+        GuardianWorker.query.get('a').heartbeat = (
+            datetime.utcnow() - timedelta(seconds=120))
+        db_session.commit()
+
+        self.assertTrue(b.heartbeat())
+        self.assertEqual(b.ring.members, ['b'])
+        self.assertTrue(b.is_leader())
+        self.assertIsNone(GuardianWorker.query.get('a'))
+
+    def test_background_heartbeat(self):
+        worker = ShardCoordinator(0.3, worker_id='a')
+        worker.heartbeat()
+        first = GuardianWorker.query.get('a').heartbeat
+        db_session.commit()
+
+        worker.start()
+        try:
+            for i in xrange(50):
+                time.sleep(0.1)
+                last = db_session.query(GuardianWorker.heartbeat).filter(
+                    GuardianWorker.id == 'a').scalar()
+                db_session.commit()
+                if last > first:
+                    break
+            self.assertGreater(last, first)
+        finally:
+            worker.leave()
+        self.assertIsNone(GuardianWorker.query.get('a'))
+
+    def test_database_snapshot(self):
+        for i in xrange(20):
+            pulse_user = PulseUser(username='user{0}'.format(i))
+            db_session.add(pulse_user)
+            db_session.add(Queue(name='queue/user{0}/0'.format(i),
+                                 owner=pulse_user))
+        db_session.commit()
+
+        workers = [ShardCoordinator(60, worker_id=worker_id)
+                   for worker_id in ('a', 'b')]
+        for worker in workers + workers:
+            worker.heartbeat()
+
+        # Each worker only loads its own queues and Pulse users.
+        snapshots = [DatabaseSnapshot(shard=worker) for worker in workers]
+        for worker, snapshot in zip(workers, snapshots):
+            self.assertGreater(len(snapshot.queues), 0)
+            self.assertTrue(all(worker.owns(name)
+                                for name in snapshot.queues))
+            self.assertTrue(all(worker.owns_key(username)
+                                for username in snapshot.pulse_users))
+        self.assertEqual(
+            sorted(snapshots[0].queues.keys() + snapshots[1].queues.keys()),
+            sorted(queue.name for queue in Queue.query))
+        self.assertEqual(len(snapshots[0].pulse_users) +
+                         len(snapshots[1].pulse_users), 20)
+
+        # The owners of Pulse users, including those without queues, are
+        # loaded along with them.
+        for i in xrange(5):
+            db_session.add(PulseUser(username='idle{0}'.format(i)))
+        db_session.commit()
+        snapshots = [DatabaseSnapshot(shard=worker) for worker in workers]
+        snapshots.append(DatabaseSnapshot())
+        with self.assertMaxQueries(0):
+            for snapshot in snapshots:
+                for pulse_user in snapshot.pulse_users.itervalues():
+                    pulse_user.owners
+
+
+class WebTest(QueryCountAssertions, unittest.TestCase):
 
     def setUp(self):
         dbinit.init_and_clear_db()
@@ -664,6 +1280,278 @@ class WebTest(unittest.TestCase):
             "mick", ",  {},   {},{},".format(*self.all_emails))
         self.assertEquals(new_emails, set(self.all_emails))
 
+    def test_queues_listing_query_count(self):
+        self.setup_3_users()
+        self.curr_user.set_admin(True)
+        for i, user in enumerate(self.all_users):
+            pulse_user = PulseUser.new_user(username='pulse{0}'.format(i),
+                                            owners=user,
+                                            create_rabbitmq_user=False)
+            for j in range(3):
+                queue = Queue(name='queue/pulse{0}/{1}'.format(i, j),
+                              owner=pulse_user, size=j)
+                db_session.add(queue)
+                db_session.add(Binding(queue_name=queue.name,
+                                       exchange='exchange/test',
+                                       routing_key='key.{0}'.format(j)))
+        db_session.add(Queue(name='queue/unowned', size=0))
+        db_session.commit()
+
+        with web.app.test_client() as c:
+            templates = "{}/pulseguardian/templates".format(os.getcwd())
+            c.application.template_folder = templates
+            with c.session_transaction() as sess:
+                sess['email'] = CONSUMER_EMAIL
+                sess['fake_account'] = True
+                sess['logged_in'] = True
+
+            # The number of queries must not depend on the number of
+            # users, queues and bindings listed.
+            with self.assertMaxQueries(12):
+                resp = c.get('/queues_listing')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('queue/pulse2/2', resp.data)
+        self.assertIn('queue/unowned', resp.data)
+        self.assertEqual(resp.data.count('exchange/test'), 9)
+
+    def test_queues_listing_snapshot(self):
+        self.setup_3_users()
+        pulse_user = PulseUser.new_user(username='snapshot',
+                                        owners=self.curr_user,
+                                        create_rabbitmq_user=False)
+        queue = Queue(name='queue/snapshot/1', owner=pulse_user, size=10)
+        db_session.add(queue)
+        db_session.commit()
+        listing.publish()
+
+        with web.app.test_client() as c:
+            templates = "{}/pulseguardian/templates".format(os.getcwd())
+            c.application.template_folder = templates
+            with c.session_transaction() as sess:
+                sess['email'] = CONSUMER_EMAIL
+                sess['fake_account'] = True
+                sess['logged_in'] = True
+
+            resp = c.get('/queues_listing')
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('10 messages', resp.data)
+            etag = resp.headers['ETag']
+
+            # Nothing changed: the queues aren't even queried.
+            with self.assertMaxQueries(3):
+                resp = c.get('/queues_listing',
+                             headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            queue = Queue.query.get('queue/snapshot/1')
+            queue.size = 20
+            db_session.commit()
+            self.assertEqual(listing.publish(), 2)
+
+            resp = c.get('/queues_listing', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('20 messages', resp.data)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_queues_snapshot_stale(self):
+        db_session.add(Queue(name='queue/stale/0', size=0))
+        db_session.commit()
+        version = listing.publish()
+        self.assertEqual(listing.load(60).version, version)
+
+        # Deleting a queue from the web app makes the snapshot stale
+        # without publishing a new one.
+        listing.mark_stale()
+        self.assertIsNone(listing.load(60))
+
+        self.assertEqual(listing.publish(), version)
+        self.assertEqual(listing.load(60).version, version)
+
+    def test_queues_snapshot_max_size(self):
+        for i in xrange(1000):
+            db_session.add(Queue(name='queue/large/{0}'.format(i), size=i))
+        db_session.commit()
+
+        max_size = config.queue_snapshot_max_size
+        try:
+            config.queue_snapshot_max_size = 0
+            version = listing.publish()
+            snapshot = listing.load(60)
+            self.assertEqual(len(snapshot.listing(User(admin=True))[1]),
+                             1000)
+            size = len(QueueSnapshot.query.get(listing.SNAPSHOT_ID).data)
+
+            # Past the maximum size, the previous snapshot is made stale
+            # rather than replaced.
+            config.queue_snapshot_max_size = size
+            db_session.add(Queue(name='queue/large/more', size=0))
+            db_session.commit()
+            self.assertIsNone(listing.publish())
+            self.assertIsNone(listing.load(60))
+            db_session.expire_all()
+            self.assertEqual(
+                QueueSnapshot.query.get(listing.SNAPSHOT_ID).version,
+                version)
+        finally:
+            config.queue_snapshot_max_size = max_size
+
+    def test_queues_listing_changes(self):
+        self.setup_3_users()
+        pulse_user = PulseUser.new_user(username='changes',
+                                        owners=self.curr_user,
+                                        create_rabbitmq_user=False)
+        for i in range(3):
+            db_session.add(Queue(name='queue/changes/{0}'.format(i),
+                                 owner=pulse_user, size=i))
+        db_session.commit()
+        version = listing.publish()
+
+        queue = Queue.query.get('queue/changes/1')
+        queue.size = 100
+        db_session.delete(Queue.query.get('queue/changes/2'))
+        db_session.commit()
+        listing.publish()
+
+        with web.app.test_client() as c:
+            templates = "{}/pulseguardian/templates".format(os.getcwd())
+            c.application.template_folder = templates
+            with c.session_transaction() as sess:
+                sess['email'] = CONSUMER_EMAIL
+                sess['fake_account'] = True
+                sess['logged_in'] = True
+
+            resp = c.get('/queues_listing')
+            self.assertIn('data-cursor="{0}"'.format(version + 1), resp.data)
+
+            resp = c.get('/queues_listing/changes?since={0}'.format(version))
+            changes = json.loads(resp.data)
+            self.assertFalse(changes['reset'])
+            self.assertEqual(changes['cursor'], version + 1)
+            self.assertEqual(changes['deleted'], ['queue/changes/2'])
+            self.assertIn('queue/changes/1', changes['html'])
+            self.assertIn('100 messages', changes['html'])
+            self.assertNotIn('queue/changes/0', changes['html'])
+
+            # Deletions before the first snapshot weren't recorded.
+            resp = c.get('/queues_listing/changes?since=0')
+            self.assertTrue(json.loads(resp.data)['reset'])
+
+    def test_api_queues(self):
+        self.setup_3_users()
+        self.curr_user.set_admin(True)
+        pulse_user = PulseUser.new_user(username='api',
+                                        owners=self.curr_user,
+                                        create_rabbitmq_user=False)
+        for i in range(5):
+            db_session.add(Queue(name='queue/api/{0}'.format(i),
+                                 owner=pulse_user, size=i % 3,
+                                 warned=i == 4))
+        db_session.add(Queue(name='queue/other/0', size=10))
+        db_session.commit()
+
+        def get_all(query):
+            names = []
+            url = '/api/queues?limit=2&' + query
+            while True:
+                page = json.loads(c.get(url).data)
+                self.assertLessEqual(len(page['queues']), 2)
+                names.extend(q['name'] for q in page['queues'])
+                if page['next'] is None:
+                    return names
+                url = '/api/queues?limit=2&{0}&after={1}'.format(
+                    query, page['next'])
+
+        with web.app.test_client() as c:
+            self.assertEqual(get_all('owner=api'),
+                             ['queue/api/{0}'.format(i) for i in range(5)])
+            self.assertEqual(get_all('sort=-size'),
+                             ['queue/other/0', 'queue/api/2', 'queue/api/4',
+                              'queue/api/1', 'queue/api/3', 'queue/api/0'])
+            self.assertEqual(get_all('sort=size&min_size=1&max_size=1'),
+                             ['queue/api/1', 'queue/api/4'])
+            self.assertEqual(get_all('prefix=queue/other/'),
+                             ['queue/other/0'])
+            self.assertEqual(get_all('warned=true'), ['queue/api/4'])
+            self.assertEqual(len(get_all('warned=false')), 5)
+
+            queue = json.loads(c.get('/api/queues?prefix=queue/api/4').data)
+            self.assertEqual(queue['queues'], [{
+                'name': 'queue/api/4', 'owner': 'api', 'size': 1,
+                'warned': True, 'durable': False, 'unbounded': False,
+            }])
+
+            self.assertEqual(c.get('/api/queues?sort=owner').status_code,
+                             400)
+            self.assertEqual(c.get('/api/queues?after=nope').status_code,
+                             400)
+
+            # Other users only get their own queues.
+            User.query.filter(User.email == self.curr_email).one() \
+                .set_admin(False)
+            self.assertEqual(get_all('sort=-size'),
+                             ['queue/api/2', 'queue/api/4', 'queue/api/1',
+                              'queue/api/3', 'queue/api/0'])
+            self.assertEqual(get_all('prefix=queue/other/'), [])
+
+    def test_bindings_listing(self):
+        self.setup_3_users()
+        self.curr_user.set_admin(True)
+        owners = [PulseUser.new_user(username='bindings',
+                                     owners=self.curr_user,
+                                     create_rabbitmq_user=False),
+                  PulseUser.new_user(username='other',
+                                     owners=self.all_users[0],
+                                     create_rabbitmq_user=False)]
+        for i, owner in enumerate(owners):
+            db_session.add(Queue(name='queue/bindings/{0}'.format(i),
+                                 owner=owner,
+                                 bindings=[Binding(exchange='exchange/test',
+                                                   routing_key=str(i))]))
+        db_session.commit()
+
+        def api_bindings(c):
+            resp = c.get('/api/bindings?queue=queue/bindings/0'
+                         '&queue=queue/bindings/1&queue=queue/none')
+            bindings = json.loads(resp.data)['bindings']
+            self.assertEqual(sorted(bindings),
+                             ['queue/bindings/0', 'queue/bindings/1',
+                              'queue/none'])
+            self.assertEqual(bindings['queue/none'], [])
+            return [[b['routing_key'] for b in bindings[name]]
+                    for name in ('queue/bindings/0', 'queue/bindings/1')]
+
+        with web.app.test_client() as c:
+            # The logged-in user, then the bindings.
+            with self.assertMaxQueries(2):
+                resp = c.get('/queue/queue/bindings/1/bindings')
+            self.assertEqual(json.loads(resp.data), {
+                'queue_name': 'queue/bindings/1',
+                'bindings': [{
+                    'source': 'exchange/test', 'vhost': '/',
+                    'destination': 'queue/bindings/1',
+                    'destination_type': 'queue', 'routing_key': '1',
+                }],
+            })
+
+            with self.assertMaxQueries(2):
+                self.assertEqual(api_bindings(c), [['0'], ['1']])
+
+            # Other users only get the bindings of their own queues.
+            User.query.filter(User.email == self.curr_email).one() \
+                .set_admin(False)
+            self.assertEqual(api_bindings(c), [['0'], []])
+            resp = c.get('/queue/queue/bindings/1/bindings')
+            self.assertEqual(json.loads(resp.data)['bindings'], [])
+
+        # Anonymous users get none.
+        try:
+            web.fake_account = None
+            with web.app.test_client() as c:
+                self.assertEqual(api_bindings(c), [[], []])
+        finally:
+            web.fake_account = config.fake_account
+
     def test_register_reserved_name(self):
         try:
             config.reserved_users_regex = 'rese[r]ved'